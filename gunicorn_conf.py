@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+
+# Production server settings: gunicorn 'src.main:app' -c gunicorn_conf.py
+bind = f"0.0.0.0:{os.environ.get('PORT', '5002')}"
+
+# Threaded workers: requests mostly wait on the database and Google APIs,
+# and argon2 releases the GIL while hashing
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+keepalive = 5
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+# Create tables and the default admin once in the master, not in every worker
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Connections opened by the master during startup must not be shared.
+    # Thread pools (src.utils.executor.WorkerPool) and the GA4 gRPC clients
+    # reset themselves in the child through os.register_at_fork.
+    from src.main import app
+    from src.models.user import db
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -1,6 +1,7 @@
+import logging
 import os
+import re
 import sys
-import os
 from datetime import timedelta
 from dotenv import load_dotenv
 
@@ -10,10 +11,16 @@ load_dotenv()
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
+# Before the app imports below, some of which log while initializing
+from src.utils.log import configure_logging
+configure_logging()
+
 from flask import Flask, send_from_directory, jsonify
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager
-from src.models.user import db, User, Client, Website, Keyword, KeywordRanking, GA4DataCache, GA4Account, GA4Property
+from werkzeug.exceptions import NotFound
+from sqlalchemy import text
+from sqlalchemy.schema import CreateColumn
+from src.models.user import db, User, Client, Website, Keyword, KeywordRanking, GA4DataCache, GA4ResponseCache, GA4Account, GA4Property
 from src.routes.user import user_bp
 from src.routes.auth import auth_bp
 from src.routes.websites import websites_bp
@@ -21,9 +28,20 @@ from src.routes.analytics import analytics_bp
 from src.routes.admin import admin_bp
 from src.routes.admin_users import admin_users_bp
 from src.routes.ga4 import ga4_bp
+from src.utils.admin_stats import create_admin_stats_view
+from src.utils.auth import token_revoked
+from src.utils.cache import cache
+from src.utils.json_provider import OrjsonProvider
+from src.utils.jwt_manager import CachingJWTManager
+
+logger = logging.getLogger(__name__)
+
+# Build assets with a content hash or version in the file name
+FINGERPRINTED_ASSET = re.compile(r'.*[.-]([0-9a-f]{8,}|v\d+)\.(js|css|png|jpg|svg|woff2)$')
 
 def create_app():
     app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+    app.json = OrjsonProvider(app)
     
     # Configuration
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -36,29 +54,56 @@ def create_app():
     database_url = os.getenv('DATABASE_URL', f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}")
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Raise on any lazy load the admin queries did not declare (dev/test only)
+    app.config['SQLALCHEMY_RAISELOAD'] = os.getenv(
+        'SQLALCHEMY_RAISELOAD', '1' if os.getenv('FLASK_ENV') == 'development' else ''
+    ).lower() in ('1', 'true', 'yes')
+    
+    # Connection pool settings for server databases (SQLite uses its own pool)
+    if not database_url.startswith('sqlite'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.getenv('SQLALCHEMY_POOL_SIZE', 30)),
+            'max_overflow': int(os.getenv('SQLALCHEMY_MAX_OVERFLOW', 10)),
+            'pool_recycle': int(os.getenv('SQLALCHEMY_POOL_RECYCLE', 3600)),
+            'pool_pre_ping': True
+        }
+    
+    # Cache configuration
+    redis_url = os.getenv('REDIS_URL')
+    app.config['CACHE_TYPE'] = 'RedisCache' if redis_url else 'SimpleCache'
+    app.config['CACHE_REDIS_URL'] = redis_url
+    app.config['CACHE_DEFAULT_TIMEOUT'] = 60
     
     # Initialize extensions
     CORS(app, origins="*", allow_headers=["Content-Type", "Authorization"])
-    jwt = JWTManager(app)
+    jwt = CachingJWTManager(app)
     db.init_app(app)
+    cache.init_app(app)
     
     # Configure JWT to allow integer subjects
     app.config['JWT_IDENTITY_CLAIM'] = 'sub'
     
+    # Tokens revoked by logout or a password change are rejected
+    jwt.token_in_blocklist_loader(token_revoked)
+    
     # JWT error handlers
     @jwt.expired_token_loader
     def expired_token_callback(jwt_header, jwt_payload):
-        print(f"JWT expired: {jwt_payload}")
+        logger.info("JWT expired for user %s", jwt_payload.get('sub'))
         return jsonify({'message': 'Token has expired'}), 401
 
     @jwt.invalid_token_loader
     def invalid_token_callback(error):
-        print(f"JWT invalid: {error}")
+        logger.info("JWT invalid: %s", error)
         return jsonify({'message': 'Invalid token'}), 401
 
+    @jwt.revoked_token_loader
+    def revoked_token_callback(jwt_header, jwt_payload):
+        return jsonify({'message': 'Token has been revoked'}), 401
+
     @jwt.unauthorized_loader
     def missing_token_callback(error):
-        print(f"JWT missing: {error}")
+        logger.info("JWT missing: %s", error)
         return jsonify({'message': 'Authorization token is required'}), 401
     
     # Register blueprints
@@ -77,8 +122,64 @@ def create_app():
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
         
+        # Trigram search indexes need the pg_trgm extension on Postgres
+        if db.engine.dialect.name == 'postgresql':
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            except Exception as e:
+                logger.warning("Could not enable pg_trgm: %s", e)
+        
         db.create_all()
         
+        # create_all doesn't alter existing tables either, so add columns
+        # declared on the models since. New columns need a server default
+        # (or to be nullable) to fill the rows already there.
+        with db.engine.begin() as conn:
+            inspector = db.inspect(conn)
+            for table in db.metadata.sorted_tables:
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+                    except Exception as e:
+                        logger.warning("Could not add column %s.%s: %s", table.name, column.name, e)
+        
+        # create_all skips tables that already exist, so add any indexes
+        # declared on the models since those tables were first created.
+        # On Postgres they are built CONCURRENTLY to avoid locking writes,
+        # which has to run outside a transaction.
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    if conn.dialect.name == 'postgresql':
+                        index.dialect_options['postgresql']['concurrently'] = True
+                    try:
+                        index.create(conn, checkfirst=True)
+                    except Exception as e:
+                        logger.warning("Could not create index %s: %s", index.name, e)
+        
+        # The website routes leave domain conflicts to the unique index. An
+        # older database with duplicate domains can't build it, so until it
+        # exists they check for a clashing domain themselves.
+        app.config['WEBSITE_DOMAIN_INDEX'] = any(
+            index['name'] == 'ix_websites_client_domain' and index['unique']
+            for index in db.inspect(db.engine).get_indexes('websites')
+        )
+        if not app.config['WEBSITE_DOMAIN_INDEX']:
+            logger.warning("Unique index ix_websites_client_domain is missing; "
+                           "remove duplicate website domains so it can be created")
+        
+        # Precomputed admin dashboard totals (Postgres only)
+        try:
+            create_admin_stats_view()
+        except Exception as e:
+            logger.warning("Could not create admin stats view: %s", e)
+        
         # Create default admin user if it doesn't exist
         admin_user = User.query.filter_by(email='adam@infinitedesigns.io').first()
         if not admin_user:
@@ -90,10 +191,11 @@ def create_app():
             admin_user.set_password('cJttMY6JKhu_zKY')
             db.session.add(admin_user)
             db.session.commit()
-            print("Created admin user: adam@infinitedesigns.io")
+            logger.info("Created admin user: adam@infinitedesigns.io")
     
     # Health check endpoint
     @app.route('/api/health')
+    @cache.cached(timeout=10)
     def health_check():
         return jsonify({'status': 'healthy', 'message': 'Analytics Dashboard API is running'})
     
@@ -105,28 +207,38 @@ def create_app():
         if static_folder_path is None:
             return "Static folder not configured", 404
 
-        if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-            return send_from_directory(static_folder_path, path)
-        else:
-            index_path = os.path.join(static_folder_path, 'index.html')
-            if os.path.exists(index_path):
-                return send_from_directory(static_folder_path, 'index.html')
-            else:
-                return jsonify({
-                    'message': 'Analytics Dashboard API',
-                    'version': '1.0.0',
-                    'endpoints': {
-                        'health': '/api/health',
-                        'auth': '/api/auth/*',
-                        'users': '/api/users/*'
-                    }
-                })
+        if path != "":
+            try:
+                if path.startswith('assets/') or FINGERPRINTED_ASSET.match(path):
+                    # Content-hashed build output never changes under the same name
+                    response = send_from_directory(static_folder_path, path, max_age=31536000)
+                    response.cache_control.immutable = True
+                    return response
+                return send_from_directory(static_folder_path, path)
+            except NotFound:
+                pass
+        
+        # SPA shell: always revalidate so new deploys pick up new asset names
+        try:
+            response = send_from_directory(static_folder_path, 'index.html', max_age=0)
+            response.cache_control.no_cache = True
+            return response
+        except NotFound:
+            return jsonify({
+                'message': 'Analytics Dashboard API',
+                'version': '1.0.0',
+                'endpoints': {
+                    'health': '/api/health',
+                    'auth': '/api/auth/*',
+                    'users': '/api/users/*'
+                }
+            })
     
     return app
 
 app = create_app()
 
+# Local development only; production runs under gunicorn (see gunicorn_conf.py)
 if __name__ == '__main__':
-    app = create_app()
     port = int(os.environ.get('PORT', 5002))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -1,9 +1,39 @@
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from src.utils.executor import WorkerPool
 from datetime import datetime
 
 db = SQLAlchemy()
 
+# Shared hasher, tuned to OWASP's lower-memory argon2id baseline (19 MiB,
+# t=2, p=1) so concurrent logins don't compete for memory bandwidth
+_ph = PasswordHasher(time_cost=2, memory_cost=19 * 1024, parallelism=1)
+
+# argon2-cffi releases the GIL while hashing, so hashes overlap request work
+_hash_pool = WorkerPool(max_workers=4, thread_name_prefix='password-hash')
+
+def hash_password_async(password):
+    """Start hashing a password off the request thread; returns a Future."""
+    return _hash_pool.submit(_ph.hash, password)
+
+class utcnow(FunctionElement):
+    """The database's current time in UTC, naive like datetime.utcnow()."""
+    type = db.DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    # SQLite's CURRENT_TIMESTAMP is already UTC
+    return 'CURRENT_TIMESTAMP'
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
 class User(db.Model):
     __tablename__ = 'users'
     
@@ -24,19 +54,58 @@ class User(db.Model):
     last_login_at = db.Column(db.DateTime)                           # Last login timestamp
     admin_notes = db.Column(db.Text)                                 # Internal admin notes
     
+    # Bumped to revoke every token issued to the user so far
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Stamped from the database clock on insert and on every UPDATE
+    updated_at = db.Column(db.DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
     
     # Relationships
-    client = db.relationship('Client', backref='user', uselist=False, cascade='all, delete-orphan')
+    client = db.relationship('Client', back_populates='user', uselist=False, cascade='all, delete-orphan', lazy='joined')
+    ga4_accounts = db.relationship('GA4Account', back_populates='user')
+
+    __table_args__ = (
+        db.Index('ix_users_active_created', 'is_active', 'created_at'),
+        # Emails are stored lowercased; this keeps them unique regardless of
+        # case on Postgres (SQLite can't reflect it for the startup backfill)
+        db.Index('ix_users_email_lower', db.func.lower(email), unique=True).ddl_if(dialect='postgresql'),
+        # Admin stats and user list filters
+        db.Index('ix_users_plan_active_custom', 'subscription_plan', 'is_active', 'custom_billing'),
+        db.Index('ix_users_sub_status', 'subscription_status'),
+        db.Index('ix_users_created_at', 'created_at'),
+        # Trigram indexes back the admin ILIKE '%term%' searches on Postgres
+        db.Index('ix_users_email_trgm', 'email', postgresql_using='gin',
+                 postgresql_ops={'email': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('ix_users_full_name_trgm', 'full_name', postgresql_using='gin',
+                 postgresql_ops={'full_name': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+    )
 
     def set_password(self, password):
         """Set password hash."""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = _ph.hash(password)
+
+    def check_password(self, password, upgrade=True):
+        """Check password against hash, upgrading legacy or stale hashes unless upgrade is False."""
+        if not self.password_hash:
+            return False
+
+        if not self.password_hash.startswith('$argon2'):
+            # Legacy werkzeug pbkdf2/scrypt hash: verify and migrate to argon2
+            if not check_password_hash(self.password_hash, password):
+                return False
+            if upgrade:
+                self.set_password(password)
+            return True
 
-    def check_password(self, password):
-        """Check password against hash."""
-        return check_password_hash(self.password_hash, password)
+        try:
+            _ph.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+        if upgrade and _ph.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def __repr__(self):
         return f'<User {self.email}>'
@@ -52,12 +121,31 @@ class User(db.Model):
             'subscription_plan': self.subscription_plan,
             'custom_billing': self.custom_billing,
             'website_limit': self.website_limit,
-            'trial_ends_at': self.trial_ends_at.isoformat() if self.trial_ends_at else None,
-            'subscription_ends_at': self.subscription_ends_at.isoformat() if self.subscription_ends_at else None,
-            'last_login_at': self.last_login_at.isoformat() if self.last_login_at else None,
+            'trial_ends_at': self.trial_ends_at,
+            'subscription_ends_at': self.subscription_ends_at,
+            'last_login_at': self.last_login_at,
             'admin_notes': self.admin_notes,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+    def to_list_dict(self):
+        """Serialize for list views, leaving out the TEXT admin_notes column."""
+        return {
+            'id': self.id,
+            'email': self.email,
+            'full_name': self.full_name,
+            'role': self.role,
+            'is_active': self.is_active,
+            'subscription_status': self.subscription_status,
+            'subscription_plan': self.subscription_plan,
+            'custom_billing': self.custom_billing,
+            'website_limit': self.website_limit,
+            'trial_ends_at': self.trial_ends_at,
+            'subscription_ends_at': self.subscription_ends_at,
+            'last_login_at': self.last_login_at,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class Client(db.Model):
@@ -72,10 +160,17 @@ class Client(db.Model):
     subscription_plan = db.Column(db.String(50), default='basic')
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
     
     # Relationships
-    websites = db.relationship('Website', backref='client', cascade='all, delete-orphan')
+    user = db.relationship('User', back_populates='client', lazy='joined')
+    websites = db.relationship('Website', back_populates='client', cascade='all, delete-orphan', lazy='selectin')
+
+    __table_args__ = (
+        db.Index('ix_clients_active_created', 'is_active', 'created_at'),
+        db.Index('ix_clients_company_trgm', 'company_name', postgresql_using='gin',
+                 postgresql_ops={'company_name': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+    )
 
     def __repr__(self):
         return f'<Client {self.company_name}>'
@@ -90,8 +185,22 @@ class Client(db.Model):
             'address': self.address,
             'subscription_plan': self.subscription_plan,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+    def to_list_dict(self):
+        """Serialize for list views, leaving out the TEXT address column."""
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'company_name': self.company_name,
+            'contact_email': self.contact_email,
+            'phone': self.phone,
+            'subscription_plan': self.subscription_plan,
+            'is_active': self.is_active,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class Website(db.Model):
@@ -104,11 +213,23 @@ class Website(db.Model):
     search_console_url = db.Column(db.String(255))
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Stamped from the database clock on insert and on every UPDATE
+    updated_at = db.Column(db.DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
     
     # Relationships
-    keywords = db.relationship('Keyword', backref='website', cascade='all, delete-orphan')
-    ga4_data_cache = db.relationship('GA4DataCache', backref='website', cascade='all, delete-orphan')
+    client = db.relationship('Client', back_populates='websites')
+    keywords = db.relationship('Keyword', back_populates='website', cascade='all, delete-orphan')
+    ga4_data_cache = db.relationship('GA4DataCache', back_populates='website', cascade='all, delete-orphan')
+    ga4_response_cache = db.relationship('GA4ResponseCache', back_populates='website', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_websites_active_created', 'is_active', 'created_at'),
+        # A domain is registered once per client; also serves lookups by client_id
+        db.Index('ix_websites_client_domain', 'client_id', 'domain', unique=True),
+        # Per-client counts and listings of live websites, such as the admin client list
+        db.Index('ix_websites_client_active', 'client_id',
+                 postgresql_where=is_active == True, sqlite_where=is_active == True),
+    )
 
     def __repr__(self):
         return f'<Website {self.domain}>'
@@ -121,8 +242,8 @@ class Website(db.Model):
             'ga4_property_id': self.ga4_property_id,
             'search_console_url': self.search_console_url,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class Keyword(db.Model):
@@ -134,10 +255,11 @@ class Keyword(db.Model):
     target_url = db.Column(db.String(500))
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
     
     # Relationships
-    rankings = db.relationship('KeywordRanking', backref='keyword', cascade='all, delete-orphan')
+    website = db.relationship('Website', back_populates='keywords')
+    rankings = db.relationship('KeywordRanking', back_populates='keyword', cascade='all, delete-orphan')
     
     # Unique constraint
     __table_args__ = (db.UniqueConstraint('website_id', 'keyword', name='unique_website_keyword'),)
@@ -152,8 +274,8 @@ class Keyword(db.Model):
             'keyword': self.keyword,
             'target_url': self.target_url,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class KeywordRanking(db.Model):
@@ -170,6 +292,9 @@ class KeywordRanking(db.Model):
     data_source = db.Column(db.String(50), nullable=False)  # 'search_console', 'serpapi', etc.
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Relationships
+    keyword = db.relationship('Keyword', back_populates='rankings')
+    
     # Unique constraint
     __table_args__ = (db.UniqueConstraint('keyword_id', 'tracking_date', 'data_source', name='unique_keyword_date_source'),)
 
@@ -185,9 +310,9 @@ class KeywordRanking(db.Model):
             'clicks': self.clicks,
             'impressions': self.impressions,
             'ctr': float(self.ctr) if self.ctr else 0,
-            'tracking_date': self.tracking_date.isoformat() if self.tracking_date else None,
+            'tracking_date': self.tracking_date,
             'data_source': self.data_source,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'created_at': self.created_at
         }
 
 class GA4DataCache(db.Model):
@@ -203,6 +328,11 @@ class GA4DataCache(db.Model):
     date_range_end = db.Column(db.Date, nullable=False)
     cached_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=False)
+    
+    # Relationships
+    website = db.relationship('Website', back_populates='ga4_data_cache')
+
+    __table_args__ = (db.Index('ix_ga4_data_cache_website_cached', 'website_id', 'cached_at'),)
 
     def __repr__(self):
         return f'<GA4DataCache {self.metric_name} - {self.website_id}>'
@@ -215,12 +345,31 @@ class GA4DataCache(db.Model):
             'dimension_name': self.dimension_name,
             'dimension_value': self.dimension_value,
             'metric_value': float(self.metric_value) if self.metric_value else 0,
-            'date_range_start': self.date_range_start.isoformat() if self.date_range_start else None,
-            'date_range_end': self.date_range_end.isoformat() if self.date_range_end else None,
-            'cached_at': self.cached_at.isoformat() if self.cached_at else None,
-            'expires_at': self.expires_at.isoformat() if self.expires_at else None
+            'date_range_start': self.date_range_start,
+            'date_range_end': self.date_range_end,
+            'cached_at': self.cached_at,
+            'expires_at': self.expires_at
         }
 
+class GA4ResponseCache(db.Model):
+    __tablename__ = 'ga4_response_cache'
+    
+    # A formatted GA4 report stored whole, under a SHA-1 of its parameters
+    key = db.Column(db.String(40), primary_key=True)
+    website_id = db.Column(db.Integer, db.ForeignKey('websites.id'), nullable=False, index=True)
+    response_json = db.Column(db.Text, nullable=False)
+    cached_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    
+    # Relationships
+    website = db.relationship('Website', back_populates='ga4_response_cache')
+
+    # Lookups go by key; this serves the purge of expired rows
+    __table_args__ = (db.Index('ix_ga4_response_cache_expires', 'expires_at'),)
+
+    def __repr__(self):
+        return f'<GA4ResponseCache {self.key} - {self.website_id}>'
+
 class GA4Account(db.Model):
     __tablename__ = 'ga4_accounts'
     
@@ -233,10 +382,11 @@ class GA4Account(db.Model):
     token_expires_at = db.Column(db.DateTime, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
     
     # Relationships
-    properties = db.relationship('GA4Property', backref='account', cascade='all, delete-orphan')
+    user = db.relationship('User', back_populates='ga4_accounts')
+    properties = db.relationship('GA4Property', back_populates='account', cascade='all, delete-orphan')
     
     # Unique constraint
     __table_args__ = (db.UniqueConstraint('user_id', 'google_account_id', name='unique_user_google_account'),)
@@ -251,8 +401,8 @@ class GA4Account(db.Model):
             'google_account_id': self.google_account_id,
             'email': self.email,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class GA4Property(db.Model):
@@ -265,10 +415,18 @@ class GA4Property(db.Model):
     website_url = db.Column(db.String(500))
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
     
-    # Unique constraint
-    __table_args__ = (db.UniqueConstraint('account_id', 'property_id', name='unique_account_property'),)
+    # Relationships
+    account = db.relationship('GA4Account', back_populates='properties')
+    
+    __table_args__ = (
+        # Also serves the (account_id, property_id) lookups
+        db.UniqueConstraint('account_id', 'property_id', name='unique_account_property'),
+        # Property lookups only ever want live rows, so index just those
+        db.Index('ix_ga4_properties_property_active', 'property_id',
+                 postgresql_where=is_active == True, sqlite_where=is_active == True),
+    )
 
     def __repr__(self):
         return f'<GA4Property {self.property_name}>'
@@ -281,7 +439,7 @@ class GA4Property(db.Model):
             'property_name': self.property_name,
             'website_url': self.website_url,
             'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
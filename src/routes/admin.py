@@ -1,30 +1,56 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from src.models.user import db, User, Client, Website
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity, get_jwt
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, defer, joinedload, lazyload, selectinload
+from src.models.user import db, User, Client, Website, hash_password_async
 from datetime import datetime, timedelta
-from functools import wraps
+from src.utils import jwt_cache
+from src.utils.auth import invalidate_user, token_claims
+from src.utils.cache import cache, cache_ok, ADMIN_STATS_KEY
+from src.utils.loading import strict_loading
+from src.utils.validation import json_payload, normalize_email, CLIENT_CREATE_FIELDS
 
 admin_bp = Blueprint('admin', __name__)
 
-def admin_required(f):
-    """Decorator to require admin role."""
-    @wraps(f)
-    @jwt_required()
-    def decorated_function(*args, **kwargs):
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
+def require_admin():
+    """Reject non-admin requests before any admin view runs."""
+    # CORS preflight carries no token; jwt_required exempted it as well
+    if request.method == 'OPTIONS':
+        return None
+    
+    verify_jwt_in_request()
+    current_user_id = int(get_jwt_identity())
+    claims = get_jwt()
+    
+    # Tokens carry the role they were issued for, so non-admins are turned
+    # away without a lookup. Admin tokens still confirm the account state.
+    if claims.get('role', 'admin') != 'admin':
+        return jsonify({'message': 'Admin access required'}), 403
+    
+    # Reuse the user state looked up for this token instead of re-querying
+    cached = jwt_cache.get(claims['jti'], current_user_id)
+    if cached is None:
+        # Only the columns needed for the check, not the full user row
+        row = db.session.query(User.role, User.is_active).filter(User.id == current_user_id).first()
+        
+        if not row:
             return jsonify({'message': 'User not found'}), 404
         
-        if user.role != 'admin':
-            return jsonify({'message': 'Admin access required'}), 403
-        
-        return f(*args, **kwargs)
-    return decorated_function
+        cached = (row.role, row.is_active)
+        jwt_cache.put(claims['jti'], current_user_id, row.role, row.is_active, claims['exp'])
+    
+    role, is_active = cached
+    
+    if not is_active:
+        return jsonify({'message': 'Account is deactivated'}), 401
+    
+    if role != 'admin':
+        return jsonify({'message': 'Admin access required'}), 403
+
+# Every admin route requires an admin; check once per request for the blueprint
+admin_bp.before_request(require_admin)
 
 @admin_bp.route('/admin/clients', methods=['GET'])
-@admin_required
 def get_all_clients():
     """Get all clients (admin only)."""
     try:
@@ -32,26 +58,41 @@ def get_all_clients():
         per_page = request.args.get('per_page', 20, type=int)
         search = request.args.get('search', '')
         
-        query = Client.query.join(User)
+        # Load the owning user from the same JOIN and count active websites
+        # in SQL so a page costs one query instead of 1 + 2 per client.
+        query = (
+            db.session.query(Client, db.func.count(Website.id).label('websites_count'))
+            .join(Client.user)
+            .outerjoin(Website, db.and_(Website.client_id == Client.id, Website.is_active == True))
+            .options(
+                # The list view never shows the TEXT columns or the password hash
+                defer(Client.address),
+                contains_eager(Client.user).defer(User.admin_notes).defer(User.password_hash),
+                lazyload(Client.websites)
+            )
+            .group_by(Client.id, User.id)
+        )
         
         if search:
+            # One bound pattern shared by the three predicates
+            pattern = db.bindparam('search', f'%{search}%')
             query = query.filter(
                 db.or_(
-                    Client.company_name.ilike(f'%{search}%'),
-                    User.email.ilike(f'%{search}%'),
-                    User.full_name.ilike(f'%{search}%')
+                    Client.company_name.ilike(pattern),
+                    User.email.ilike(pattern),
+                    User.full_name.ilike(pattern)
                 )
             )
         
-        clients = query.paginate(
+        clients = strict_loading(query).paginate(
             page=page, per_page=per_page, error_out=False
         )
         
         clients_data = []
-        for client in clients.items:
-            client_dict = client.to_dict()
-            client_dict['user'] = client.user.to_dict()
-            client_dict['websites_count'] = len(client.websites)
+        for client, websites_count in clients.items:
+            client_dict = client.to_list_dict()
+            client_dict['user'] = client.user.to_list_dict()
+            client_dict['websites_count'] = websites_count
             clients_data.append(client_dict)
         
         return jsonify({
@@ -70,37 +111,32 @@ def get_all_clients():
         return jsonify({'message': f'Failed to get clients: {str(e)}'}), 500
 
 @admin_bp.route('/admin/clients', methods=['POST'])
-@admin_required
 def create_client():
     """Create a new client (admin only)."""
     try:
-        data = request.get_json()
+        data, error = json_payload(CLIENT_CREATE_FIELDS)
+        if error:
+            return error
         
-        required_fields = ['email', 'password', 'full_name', 'company_name']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'message': f'{field} is required'}), 400
+        email = normalize_email(data.get('email'))
         
-        email = data.get('email').lower().strip()
+        # Hash in the background while the duplicate check runs
+        pending_hash = hash_password_async(data.get('password'))
         
         # Check if user already exists
-        if User.query.filter_by(email=email).first():
+        if db.session.query(db.exists().where(User.email == email)).scalar():
             return jsonify({'message': 'User with this email already exists'}), 409
         
-        # Create new user
         user = User(
             email=email,
             full_name=data.get('full_name'),
+            password_hash=pending_hash.result(),
             role='client'
         )
-        user.set_password(data.get('password'))
-        
-        db.session.add(user)
-        db.session.flush()  # Get user ID
         
-        # Create client profile
+        # Create client profile; the flush inserts the user first and fills in user_id
         client = Client(
-            user_id=user.id,
+            user=user,
             company_name=data.get('company_name'),
             contact_email=data.get('contact_email', email),
             phone=data.get('phone'),
@@ -109,26 +145,37 @@ def create_client():
         )
         
         db.session.add(client)
-        db.session.commit()
+        db.session.flush()
         
+        # Serialize before commit so the response doesn't reload both rows
         client_dict = client.to_dict()
         client_dict['user'] = user.to_dict()
         
+        db.session.commit()
+        cache.delete(ADMIN_STATS_KEY)
+        
         return jsonify({
             'message': 'Client created successfully',
             'client': client_dict
         }), 201
         
+    except IntegrityError:
+        # Another request took the email between the check and the write
+        db.session.rollback()
+        return jsonify({'message': 'User with this email already exists'}), 409
+        
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Failed to create client: {str(e)}'}), 500
 
 @admin_bp.route('/admin/clients/<int:client_id>', methods=['GET'])
-@admin_required
 def get_client(client_id):
     """Get a specific client (admin only)."""
     try:
-        client = Client.query.get(client_id)
+        client = strict_loading(Client.query.options(
+            joinedload(Client.user),
+            selectinload(Client.websites)
+        )).filter_by(id=client_id).first()
         if not client:
             return jsonify({'message': 'Client not found'}), 404
         
@@ -142,16 +189,20 @@ def get_client(client_id):
         return jsonify({'message': f'Failed to get client: {str(e)}'}), 500
 
 @admin_bp.route('/admin/clients/<int:client_id>', methods=['PUT'])
-@admin_required
 def update_client(client_id):
     """Update a client (admin only)."""
     try:
-        client = Client.query.get(client_id)
+        data, error = json_payload()
+        if error:
+            return error
+        
+        # Start hashing a new password while the client is loaded
+        pending_hash = hash_password_async(data['password']) if data.get('password') else None
+        
+        client = db.session.get(Client, client_id)
         if not client:
             return jsonify({'message': 'Client not found'}), 404
         
-        data = request.get_json()
-        
         # Update client fields
         if 'company_name' in data:
             client.company_name = data['company_name']
@@ -166,20 +217,25 @@ def update_client(client_id):
         if 'is_active' in data:
             client.is_active = data['is_active']
         
-        client.updated_at = datetime.utcnow()
         
         # Update user fields
         user = client.user
         if 'full_name' in data:
             user.full_name = data['full_name']
         if 'is_active' in data:
+            if user.is_active and not data['is_active']:
+                # A deactivated user is signed out everywhere
+                user.token_version += 1
             user.is_active = data['is_active']
-        if 'password' in data and data['password']:
-            user.set_password(data['password'])
+        if pending_hash:
+            # A password reset signs the user out everywhere
+            user.password_hash = pending_hash.result()
+            user.token_version += 1
         
-        user.updated_at = datetime.utcnow()
         
         db.session.commit()
+        cache.delete(ADMIN_STATS_KEY)
+        invalidate_user(user.id)
         
         client_dict = client.to_dict()
         client_dict['user'] = user.to_dict()
@@ -194,21 +250,21 @@ def update_client(client_id):
         return jsonify({'message': f'Failed to update client: {str(e)}'}), 500
 
 @admin_bp.route('/admin/clients/<int:client_id>', methods=['DELETE'])
-@admin_required
 def delete_client(client_id):
     """Delete a client (admin only)."""
     try:
-        client = Client.query.get(client_id)
+        client = db.session.get(Client, client_id)
         if not client:
             return jsonify({'message': 'Client not found'}), 404
         
         # Soft delete by setting is_active to False
         client.is_active = False
         client.user.is_active = False
-        client.updated_at = datetime.utcnow()
-        client.user.updated_at = datetime.utcnow()
+        client.user.token_version += 1
         
         db.session.commit()
+        cache.delete(ADMIN_STATS_KEY)
+        invalidate_user(client.user_id)
         
         return jsonify({'message': 'Client deleted successfully'}), 200
         
@@ -217,15 +273,17 @@ def delete_client(client_id):
         return jsonify({'message': f'Failed to delete client: {str(e)}'}), 500
 
 @admin_bp.route('/admin/clients/<int:client_id>/websites', methods=['GET'])
-@admin_required
 def get_client_websites(client_id):
     """Get all websites for a specific client (admin only)."""
     try:
-        client = Client.query.get(client_id)
+        # Only the company name is needed, so skip loading the client row
+        # along with its eager user and websites relationships
+        client = db.session.query(Client.id, Client.company_name).filter_by(id=client_id).first()
         if not client:
             return jsonify({'message': 'Client not found'}), 404
         
-        websites_data = [website.to_dict() for website in client.websites]
+        websites = strict_loading(Website.query.filter_by(client_id=client_id)).all()
+        websites_data = [website.to_dict() for website in websites]
         
         return jsonify({
             'client_id': client_id,
@@ -238,16 +296,27 @@ def get_client_websites(client_id):
         return jsonify({'message': f'Failed to get client websites: {str(e)}'}), 500
 
 @admin_bp.route('/admin/stats', methods=['GET'])
-@admin_required
+@cache.cached(timeout=60, key_prefix=ADMIN_STATS_KEY, response_filter=cache_ok)
 def get_admin_stats():
     """Get admin dashboard statistics."""
     try:
-        stats = {
-            'total_clients': Client.query.filter_by(is_active=True).count(),
-            'total_websites': Website.query.filter_by(is_active=True).count(),
-            'total_users': User.query.filter_by(is_active=True).count(),
-            'clients_by_plan': {}
-        }
+        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+        
+        def count_of(model, *criteria):
+            return db.session.query(db.func.count(model.id)).filter(*criteria).scalar_subquery()
+        
+        # All headline counts in one round trip
+        totals = db.session.query(
+            count_of(Client, Client.is_active == True).label('total_clients'),
+            count_of(Website, Website.is_active == True).label('total_websites'),
+            count_of(User, User.is_active == True).label('total_users'),
+            # Recent activity (last 30 days)
+            count_of(Client, Client.created_at >= thirty_days_ago).label('recent_clients'),
+            count_of(Website, Website.created_at >= thirty_days_ago).label('recent_websites')
+        ).one()
+        
+        stats = dict(totals._mapping)
+        stats['clients_by_plan'] = {}
         
         # Get clients by subscription plan
         plans = db.session.query(
@@ -258,44 +327,48 @@ def get_admin_stats():
         for plan, count in plans:
             stats['clients_by_plan'][plan] = count
         
-        # Recent activity (last 30 days)
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        stats['recent_clients'] = Client.query.filter(
-            Client.created_at >= thirty_days_ago
-        ).count()
-        
-        stats['recent_websites'] = Website.query.filter(
-            Website.created_at >= thirty_days_ago
-        ).count()
-        
         return jsonify(stats), 200
         
     except Exception as e:
         return jsonify({'message': f'Failed to get admin stats: {str(e)}'}), 500
 
 @admin_bp.route('/admin/clients/<int:client_id>/impersonate', methods=['POST'])
-@admin_required
 def impersonate_client(client_id):
     """Impersonate a client for testing (admin only)."""
     try:
-        client = Client.query.get(client_id)
+        # Client and user from one JOIN; the password hash is never needed here.
+        # The user's own client reference is the same row, joined again so
+        # the token claims don't need another query.
+        client = db.session.execute(
+            db.select(Client)
+            .join(Client.user)
+            .where(Client.id == client_id)
+            .options(
+                contains_eager(Client.user).options(
+                    defer(User.password_hash), joinedload(User.client).lazyload(Client.websites)
+                ),
+                lazyload(Client.websites)
+            )
+        ).scalar_one_or_none()
         if not client:
             return jsonify({'message': 'Client not found'}), 404
         
-        if not client.is_active or not client.user.is_active:
+        user = client.user
+        
+        if not client.is_active or not user.is_active:
             return jsonify({'message': 'Client account is inactive'}), 400
         
-        # Create tokens for the client user
+        # Create tokens for the client user with string identity
         from flask_jwt_extended import create_access_token, create_refresh_token
         
-        access_token = create_access_token(identity=client.user.id)
-        refresh_token = create_refresh_token(identity=client.user.id)
+        access_token = create_access_token(identity=str(user.id), additional_claims=token_claims(user))
+        refresh_token = create_refresh_token(identity=str(user.id), additional_claims=token_claims(user))
         
         return jsonify({
             'message': f'Impersonating client: {client.company_name}',
             'access_token': access_token,
             'refresh_token': refresh_token,
-            'user': client.user.to_dict(),
+            'user': user.to_dict(),
             'client': client.to_dict()
         }), 200
         
@@ -1,30 +1,42 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from src.models.user import db, User, Client, Website
+from flask import Blueprint, current_app, request, jsonify
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.exc import IntegrityError
+from src.models.user import db, User, Client, Website, utcnow
+from src.routes.admin import require_admin
+from src.utils.admin_stats import PLAN_PRICES, admin_user_totals
+from src.utils.auth import invalidate_user, token_claims
+from src.utils.validation import normalize_email
 from datetime import datetime, timedelta
-from functools import wraps
+import base64
+import json
 
 admin_users_bp = Blueprint('admin_users', __name__)
 
-def admin_required(f):
-    """Decorator to require admin role."""
-    @wraps(f)
-    @jwt_required()
-    def decorated_function(*args, **kwargs):
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        if user.role != 'admin':
-            return jsonify({'message': 'Admin access required'}), 403
-        
-        return f(*args, **kwargs)
-    return decorated_function
+# Upper bound on sub-requests accepted by /admin/batch
+MAX_BATCH_REQUESTS = 10
+
+# Upper bound on users returned per page of /admin/users
+MAX_PER_PAGE = 200
+
+# Account flags written for each admin-selectable status. Deactivating also
+# bumps token_version, in the same UPDATE, so the user's tokens stop working
+STATUS_VALUES = {
+    'active': {'is_active': True, 'subscription_status': 'active'},
+    'trial': {'is_active': True, 'subscription_status': 'trial'},
+    'suspended': {'is_active': False, 'subscription_status': 'suspended', 'token_version': User.token_version + 1},
+    'expired': {'is_active': False, 'subscription_status': 'expired', 'token_version': User.token_version + 1}
+}
+
+# User columns returned by the users list, i.e. User.to_list_dict without
+# going through ORM instances
+USER_LIST_COLUMNS = (
+    'id', 'email', 'full_name', 'role', 'is_active', 'subscription_status',
+    'subscription_plan', 'custom_billing', 'website_limit', 'trial_ends_at',
+    'subscription_ends_at', 'last_login_at', 'created_at', 'updated_at'
+)
+admin_users_bp.before_request(require_admin)
 
 @admin_users_bp.route('/admin/users', methods=['GET'])
-@admin_required
 def get_all_users():
     """Get all users with detailed information for admin panel."""
     try:
@@ -33,15 +45,52 @@ def get_all_users():
         search = request.args.get('search', '')
         status_filter = request.args.get('status', 'all')
         
-        query = User.query.outerjoin(Client)
+        if not 1 <= per_page <= MAX_PER_PAGE:
+            return jsonify({'message': f'per_page must be between 1 and {MAX_PER_PAGE}'}), 400
+        
+        # Count each client's websites in SQL and read the client from the
+        # same outer join, so a page is one query plus the pagination count
+        website_count = (
+            db.session.query(db.func.count(Website.id))
+            .filter(Website.client_id == Client.id)
+            .correlate(Client)
+            .scalar_subquery()
+        )
+        # Only the columns the admin UI renders, as plain rows instead of
+        # User/Client instances (admin_notes and password_hash stay behind)
+        query = (
+            db.session.query(
+                *[getattr(User, name) for name in USER_LIST_COLUMNS],
+                Client.id.label('client_id'),
+                Client.company_name,
+                Client.subscription_plan.label('client_plan'),
+                website_count.label('website_count'),
+                # get_user_status/get_user_plan, evaluated by the database.
+                # Python's falsy checks: a NULL is_active counts as suspended
+                # and an empty plan falls through to the next one.
+                db.case(
+                    (User.is_active.is_not(True), 'suspended'),
+                    (User.subscription_status == 'trial', 'trial'),
+                    (User.subscription_status == 'expired', 'expired'),
+                    (User.subscription_status == 'active', 'active'),
+                    else_='trial'
+                ).label('status'),
+                db.func.coalesce(
+                    db.func.nullif(User.subscription_plan, ''), db.func.nullif(Client.subscription_plan, ''), 'free'
+                ).label('plan')
+            )
+            .outerjoin(User.client)
+        )
         
         # Search filter
         if search:
+            # One bound pattern shared by the three predicates
+            pattern = db.bindparam('search', f'%{search}%')
             query = query.filter(
                 db.or_(
-                    User.email.ilike(f'%{search}%'),
-                    User.full_name.ilike(f'%{search}%'),
-                    Client.company_name.ilike(f'%{search}%')
+                    User.email.ilike(pattern),
+                    User.full_name.ilike(pattern),
+                    Client.company_name.ilike(pattern)
                 )
             )
         
@@ -56,35 +105,43 @@ def get_all_users():
             elif status_filter == 'expired':
                 query = query.filter(User.subscription_status == 'expired')
         
-        users = query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-        
-        users_data = []
-        for user in users.items:
-            user_dict = user.to_dict()
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            # Keyset pagination: no COUNT(*) and no OFFSET skip. An empty
+            # cursor starts from the newest user.
+            query = query.order_by(User.created_at.desc(), User.id.desc())
+            if cursor:
+                try:
+                    cursor_ts, cursor_id = decode_user_cursor(cursor)
+                except (ValueError, TypeError):
+                    return jsonify({'message': 'Invalid cursor'}), 400
+                query = query.filter(db.tuple_(User.created_at, User.id) < db.tuple_(cursor_ts, cursor_id))
             
-            # Add client information if exists
-            if user.client:
-                user_dict['company'] = user.client.company_name
-                user_dict['subscription_plan'] = user.client.subscription_plan
-                user_dict['websiteCount'] = len(user.client.websites)
-            else:
-                user_dict['company'] = None
-                user_dict['subscription_plan'] = 'free'
-                user_dict['websiteCount'] = 0
-            
-            # Add computed fields
-            user_dict['status'] = get_user_status(user)
-            user_dict['plan'] = get_user_plan(user)
-            user_dict['customBilling'] = getattr(user, 'custom_billing', False)
-            user_dict['lastLogin'] = user.last_login_at.isoformat() if user.last_login_at else None
-            
-            users_data.append(user_dict)
-        
-        return jsonify({
-            'users': users_data,
-            'pagination': {
+            rows = query.limit(per_page + 1).all()
+            has_next = len(rows) > per_page
+            rows = rows[:per_page]
+            pagination = {
+                'per_page': per_page,
+                'has_next': has_next,
+                'next_cursor': encode_user_cursor(rows[-1]) if has_next else None
+            }
+        else:
+            # The ILIKE filter is served by the pg_trgm GIN indexes on
+            # Postgres; rank those matches by trigram similarity as well
+            if search and db.session.get_bind().dialect.name == 'postgresql':
+                query = query.order_by(
+                    db.func.greatest(
+                        db.func.similarity(User.email, search),
+                        db.func.similarity(User.full_name, search),
+                        db.func.coalesce(db.func.similarity(Client.company_name, search), 0)
+                    ).desc(),
+                    User.id
+                )
+            users = query.paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            rows = users.items
+            pagination = {
                 'page': users.page,
                 'pages': users.pages,
                 'per_page': users.per_page,
@@ -92,55 +149,54 @@ def get_all_users():
                 'has_next': users.has_next,
                 'has_prev': users.has_prev
             }
+        
+        # Built in full before the response starts, so a failure while
+        # reading or serializing a row still answers 500 instead of a
+        # truncated 200; a page is at most MAX_PER_PAGE rows
+        return jsonify({
+            'users': [user_list_dict(row) for row in rows],
+            'pagination': pagination
         }), 200
         
     except Exception as e:
         return jsonify({'message': f'Failed to get users: {str(e)}'}), 500
 
 @admin_users_bp.route('/admin/users/<int:user_id>/status', methods=['PUT'])
-@admin_required
 def update_user_status(user_id):
     """Update user account status (active, suspended, etc.)."""
     try:
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
         data = request.get_json()
         status = data.get('status')
         
-        if status not in ['active', 'trial', 'suspended', 'expired']:
+        if status not in STATUS_VALUES:
             return jsonify({'message': 'Invalid status'}), 400
         
-        # Update user status
-        if status == 'active':
-            user.is_active = True
-            user.subscription_status = 'active'
-        elif status == 'trial':
-            user.is_active = True
-            user.subscription_status = 'trial'
+        values = dict(STATUS_VALUES[status])
+        if status == 'trial':
             # Set trial expiration if not set
-            if not user.trial_ends_at:
-                user.trial_ends_at = datetime.utcnow() + timedelta(days=14)
-        elif status == 'suspended':
-            user.is_active = False
-            user.subscription_status = 'suspended'
-        elif status == 'expired':
-            user.is_active = False
-            user.subscription_status = 'expired'
+            values['trial_ends_at'] = db.func.coalesce(User.trial_ends_at, datetime.utcnow() + timedelta(days=14))
         
-        user.updated_at = datetime.utcnow()
+        # Update and read back the user in one statement instead of load-then-flush
+        user = update_user_returning(user_id, values)
+        if not user:
+            return jsonify({'message': 'User not found'}), 404
         
         # Update client if exists
-        if user.client:
-            user.client.is_active = user.is_active
-            user.client.updated_at = datetime.utcnow()
+        db.session.execute(
+            db.update(Client)
+            .where(Client.user_id == user_id)
+            .values(is_active=user.is_active)
+        )
+        
+        # Serialize before commit so the response doesn't reload the user
+        user_dict = user.to_dict()
         
         db.session.commit()
+        invalidate_user(user_id)
         
         return jsonify({
             'message': 'User status updated successfully',
-            'user': user.to_dict()
+            'user': user_dict
         }), 200
         
     except Exception as e:
@@ -148,14 +204,9 @@ def update_user_status(user_id):
         return jsonify({'message': f'Failed to update user status: {str(e)}'}), 500
 
 @admin_users_bp.route('/admin/users/<int:user_id>/plan', methods=['PUT'])
-@admin_required
 def update_user_plan(user_id):
     """Update user subscription plan and billing settings."""
     try:
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
         data = request.get_json()
         plan = data.get('plan')
         custom_billing = data.get('customBilling', False)
@@ -163,16 +214,30 @@ def update_user_plan(user_id):
         if plan not in ['free', 'starter', 'professional', 'agency']:
             return jsonify({'message': 'Invalid plan'}), 400
         
-        # Update user plan
-        user.subscription_plan = plan
-        user.custom_billing = custom_billing
-        user.updated_at = datetime.utcnow()
+        values = {
+            'subscription_plan': plan,
+            'custom_billing': custom_billing
+        }
+        
+        # Set appropriate status based on plan
+        if plan == 'free':
+            values['subscription_status'] = 'trial'
+            values['trial_ends_at'] = db.func.coalesce(User.trial_ends_at, datetime.utcnow() + timedelta(days=14))
+        else:
+            values['subscription_status'] = 'active'
+            values['is_active'] = True
+        
+        user = update_user_returning(user_id, values)
+        if not user:
+            return jsonify({'message': 'User not found'}), 404
         
         # Update client if exists
-        if user.client:
-            user.client.subscription_plan = plan
-            user.client.updated_at = datetime.utcnow()
-        else:
+        updated = db.session.execute(
+            db.update(Client)
+            .where(Client.user_id == user_id)
+            .values(subscription_plan=plan)
+        )
+        if not updated.rowcount:
             # Create client record if doesn't exist
             client = Client(
                 user_id=user.id,
@@ -182,20 +247,15 @@ def update_user_plan(user_id):
             )
             db.session.add(client)
         
-        # Set appropriate status based on plan
-        if plan == 'free':
-            user.subscription_status = 'trial'
-            if not user.trial_ends_at:
-                user.trial_ends_at = datetime.utcnow() + timedelta(days=14)
-        else:
-            user.subscription_status = 'active'
-            user.is_active = True
+        # Serialize before commit so the response doesn't reload the user
+        user_dict = user.to_dict()
         
         db.session.commit()
+        invalidate_user(user_id)
         
         return jsonify({
             'message': 'User plan updated successfully',
-            'user': user.to_dict()
+            'user': user_dict
         }), 200
         
     except Exception as e:
@@ -203,70 +263,62 @@ def update_user_plan(user_id):
         return jsonify({'message': f'Failed to update user plan: {str(e)}'}), 500
 
 @admin_users_bp.route('/admin/users/<int:user_id>', methods=['PUT'])
-@admin_required
 def update_user(user_id):
     """Update user details including personal info and settings."""
     try:
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
         data = request.get_json()
         
+        # Touch both rows even when no listed field is given
+        values = {'updated_at': utcnow()}
+        
         # Update basic user fields
         if 'name' in data:
-            user.full_name = data['name']
+            values['full_name'] = data['name']
         if 'email' in data:
+            # Stored normalized like at login and registration
+            email = normalize_email(data['email'])
+            
             # Check if email is already taken
-            existing_user = User.query.filter(
-                User.email == data['email'], 
-                User.id != user_id
-            ).first()
-            if existing_user:
+            email_taken = db.session.query(
+                db.exists().where(User.email == email, User.id != user_id)
+            ).scalar()
+            if email_taken:
                 return jsonify({'message': 'Email already in use'}), 409
-            user.email = data['email']
+            values['email'] = email
         
         # Update subscription settings
-        if 'status' in data:
-            status = data['status']
-            if status == 'active':
-                user.is_active = True
-                user.subscription_status = 'active'
-            elif status == 'trial':
-                user.is_active = True
-                user.subscription_status = 'trial'
-            elif status == 'suspended':
-                user.is_active = False
-                user.subscription_status = 'suspended'
-            elif status == 'expired':
-                user.is_active = False
-                user.subscription_status = 'expired'
+        if 'status' in data and data['status'] in STATUS_VALUES:
+            values.update(STATUS_VALUES[data['status']])
         
         if 'plan' in data:
-            user.subscription_plan = data['plan']
+            values['subscription_plan'] = data['plan']
         
         if 'customBilling' in data:
-            user.custom_billing = data['customBilling']
+            values['custom_billing'] = data['customBilling']
         
         if 'websiteLimit' in data:
-            user.website_limit = data['websiteLimit']
+            values['website_limit'] = data['websiteLimit']
         
         if 'expirationDate' in data and data['expirationDate']:
-            user.subscription_ends_at = datetime.fromisoformat(data['expirationDate'])
+            values['subscription_ends_at'] = datetime.fromisoformat(data['expirationDate'])
         
         if 'notes' in data:
-            user.admin_notes = data['notes']
+            values['admin_notes'] = data['notes']
         
-        user.updated_at = datetime.utcnow()
+        user = update_user_returning(user_id, values)
+        if not user:
+            return jsonify({'message': 'User not found'}), 404
         
         # Update client record if exists
-        if user.client:
-            if 'company' in data:
-                user.client.company_name = data['company']
-            if 'plan' in data:
-                user.client.subscription_plan = data['plan']
-            user.client.updated_at = datetime.utcnow()
-        elif 'company' in data:
+        client_values = {'updated_at': utcnow()}
+        if 'company' in data:
+            client_values['company_name'] = data['company']
+        if 'plan' in data:
+            client_values['subscription_plan'] = data['plan']
+        updated = db.session.execute(
+            db.update(Client).where(Client.user_id == user_id).values(**client_values)
+        )
+        if not updated.rowcount and 'company' in data:
             # Create client record if company is provided
             client = Client(
                 user_id=user.id,
@@ -276,49 +328,40 @@ def update_user(user_id):
             )
             db.session.add(client)
         
+        # Serialize before commit so the response doesn't reload the user
+        user_dict = user.to_dict()
+        
         db.session.commit()
+        invalidate_user(user_id)
         
         return jsonify({
             'message': 'User updated successfully',
-            'user': user.to_dict()
+            'user': user_dict
         }), 200
         
+    except IntegrityError:
+        # Another request took the email between the check and the write
+        db.session.rollback()
+        return jsonify({'message': 'Email already in use'}), 409
+        
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Failed to update user: {str(e)}'}), 500
 
-@admin_users_bp.route('/admin/stats', methods=['GET'])
-@admin_required
-def get_admin_stats():
-    """Get comprehensive admin dashboard statistics."""
+# Its own path: /admin/stats belongs to admin_bp, which is registered first
+@admin_users_bp.route('/admin/users/stats', methods=['GET'])
+def get_user_stats():
+    """Get user and revenue totals for the admin users dashboard."""
     try:
-        # Basic counts
-        total_users = User.query.count()
-        active_users = User.query.filter_by(is_active=True).count()
-        trial_users = User.query.filter_by(subscription_status='trial').count()
-        custom_billing_users = User.query.filter_by(custom_billing=True).count()
-        
-        # Revenue calculation (simplified)
-        plan_prices = {
-            'starter': 49,
-            'professional': 99,
-            'agency': 199
-        }
+        # A single precomputed row on Postgres, one scan of users elsewhere
+        totals = admin_user_totals()
         
-        monthly_revenue = 0
-        for plan, price in plan_prices.items():
-            count = User.query.filter(
-                User.subscription_plan == plan,
-                User.is_active == True,
-                User.custom_billing == False
-            ).count()
-            monthly_revenue += count * price
-        
-        # Recent activity (last 30 days)
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        recent_signups = User.query.filter(
-            User.created_at >= thirty_days_ago
-        ).count()
+        total_users = totals.total_users
+        active_users = totals.active_users
+        trial_users = totals.trial_users
+        custom_billing_users = totals.custom_billing_users
+        recent_signups = totals.recent_signups
+        monthly_revenue = sum(totals._mapping[plan] * price for plan, price in PLAN_PRICES.items())
         
         stats = {
             'totalUsers': total_users,
@@ -332,14 +375,13 @@ def get_admin_stats():
         return jsonify({'stats': stats}), 200
         
     except Exception as e:
-        return jsonify({'message': f'Failed to get admin stats: {str(e)}'}), 500
+        return jsonify({'message': f'Failed to get user stats: {str(e)}'}), 500
 
 @admin_users_bp.route('/admin/users/<int:user_id>/impersonate', methods=['POST'])
-@admin_required
 def impersonate_user(user_id):
     """Impersonate a user for support purposes."""
     try:
-        user = User.query.get(user_id)
+        user = db.session.get(User, user_id)
         if not user:
             return jsonify({'message': 'User not found'}), 404
         
@@ -349,8 +391,8 @@ def impersonate_user(user_id):
         # Create tokens for the target user
         from flask_jwt_extended import create_access_token, create_refresh_token
         
-        access_token = create_access_token(identity=user.id)
-        refresh_token = create_refresh_token(identity=user.id)
+        access_token = create_access_token(identity=str(user.id), additional_claims=token_claims(user))
+        refresh_token = create_refresh_token(identity=str(user.id), additional_claims=token_claims(user))
         
         return jsonify({
             'message': f'Impersonating user: {user.full_name or user.email}',
@@ -362,6 +404,80 @@ def impersonate_user(user_id):
     except Exception as e:
         return jsonify({'message': f'Failed to impersonate user: {str(e)}'}), 500
 
+@admin_users_bp.route('/admin/batch', methods=['POST'])
+def batch_requests():
+    """Run several admin GET requests in one call, e.g. the dashboard's first paint."""
+    try:
+        sub_requests = request.get_json()
+        
+        if not isinstance(sub_requests, list) or not sub_requests:
+            return jsonify({'message': 'A list of requests is required'}), 400
+        
+        if len(sub_requests) > MAX_BATCH_REQUESTS:
+            return jsonify({'message': f'At most {MAX_BATCH_REQUESTS} requests per batch'}), 400
+        
+        # The admin check already ran for the batch itself, so each sub-request
+        # is dispatched straight to its view without the before_request hooks.
+        # The caller's token is passed on for views that read it. Each one
+        # also gets its own app context, so g and the db session start fresh
+        # instead of carrying state over from the previous sub-request.
+        headers = {'Authorization': request.headers.get('Authorization', '')}
+        responses = []
+        for sub_request in sub_requests:
+            path = sub_request.get('path', '') if isinstance(sub_request, dict) else ''
+            if not path.startswith('/'):
+                responses.append({'status': 400, 'body': {'message': 'Invalid path'}})
+                continue
+            if not path.startswith('/api/'):
+                path = '/api' + path
+            
+            with current_app.app_context(), current_app.test_request_context(path, method='GET', query_string=sub_request.get('query'), headers=headers):
+                # Only API views; the SPA catch-all would answer any other path
+                if request.url_rule is not None and request.blueprint is None:
+                    responses.append({'status': 404, 'body': {'message': 'Not found'}})
+                    continue
+                try:
+                    response = current_app.make_response(current_app.dispatch_request())
+                except HTTPException as e:
+                    response = current_app.make_response(current_app.handle_user_exception(e))
+                responses.append({'status': response.status_code, 'body': response.get_json(silent=True)})
+        
+        return jsonify({'responses': responses}), 200
+        
+    except Exception as e:
+        return jsonify({'message': f'Failed to run batch: {str(e)}'}), 500
+
+def update_user_returning(user_id, values):
+    """UPDATE a user and return the updated row as a User, or None if it doesn't exist."""
+    return db.session.execute(
+        db.update(User)
+        .where(User.id == user_id)
+        .values(**values)
+        .returning(User)
+    ).scalar_one_or_none()
+
+def user_list_dict(row):
+    """Build a users list entry from a get_all_users row."""
+    user_dict = {name: row._mapping[name] for name in USER_LIST_COLUMNS}
+    
+    # Add client information if exists
+    if row.client_id is not None:
+        user_dict['company'] = row.company_name
+        user_dict['subscription_plan'] = row.client_plan
+        user_dict['websiteCount'] = row.website_count
+    else:
+        user_dict['company'] = None
+        user_dict['subscription_plan'] = 'free'
+        user_dict['websiteCount'] = 0
+    
+    # Add computed fields
+    user_dict['status'] = row.status
+    user_dict['plan'] = row.plan
+    user_dict['customBilling'] = row.custom_billing
+    user_dict['lastLogin'] = row.last_login_at
+    
+    return user_dict
+
 def get_user_status(user):
     """Determine user status based on various factors."""
     if not user.is_active:
@@ -384,3 +500,12 @@ def get_user_plan(user):
     else:
         return 'free'
 
+def encode_user_cursor(user):
+    """Encode a user row's (created_at, id) sort key as an opaque cursor."""
+    key = json.dumps([user.created_at.isoformat(), user.id])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+def decode_user_cursor(cursor):
+    """Decode a cursor from encode_user_cursor back into (created_at, id)."""
+    created_at, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(created_at), int(user_id)
@@ -1,171 +1,141 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from src.models.user import db, User, Website
-from src.services.ga4_service_simple import ga4_service
-from datetime import datetime, timedelta
+from flask_jwt_extended import jwt_required
+from src.models.user import db, Website, GA4ResponseCache
+from src.utils.auth import current_principal
+from src.utils.loading import strict_loading
+from src.services.ga4_service import ga4_service
+from src.utils.executor import WorkerPool
+from datetime import date, datetime, timedelta
+from functools import wraps
 
 analytics_bp = Blueprint('analytics', __name__)
 
-def check_website_access(user, website_id):
-    """Check if user has access to the website."""
-    website = Website.query.get(website_id)
-    if not website:
-        return None, {'message': 'Website not found'}, 404
+# Shared pool for GA4 API calls made alongside other GA4 requests
+_ga4_pool = WorkerPool(max_workers=8, thread_name_prefix='ga4')
+
+# Cached GA4 reports, by the metric name they are cached under
+METRIC_FETCHERS = {
+    'overview': ga4_service.get_overview_metrics,
+    'traffic_sources': ga4_service.get_traffic_sources,
+    'page_performance': ga4_service.get_page_performance
+}
+
+# How each report is named in error messages
+METRIC_LABELS = {
+    'overview': 'overview data',
+    'traffic_sources': 'traffic data',
+    'page_performance': 'page performance data'
+}
+
+def check_website_access(principal, website_id):
+    """Check if the principal has access to the website."""
+    # Reused by every access check for the same website within a request.
+    # Kept on the request, not g: /admin/batch sub-requests would share g.
+    websites = request.environ.setdefault('analytics.websites', {})
+    if website_id not in websites:
+        websites[website_id] = _load_accessible_website(principal, website_id)
+    return websites[website_id]
+
+def _load_accessible_website(principal, website_id):
+    # The ownership test is part of the lookup, so the common case is one query
+    query = db.select(Website).where(Website.id == website_id)
+    if principal.role == 'client':
+        query = query.where(Website.client_id == principal.client_id)
     
-    # Check permissions
-    if user.role == 'client':
-        if not user.client or website.client_id != user.client.id:
-            return None, {'message': 'Access denied'}, 403
+    website = db.session.execute(strict_loading(query)).scalar_one_or_none()
+    if website:
+        return website, None, None
     
-    return website, None, None
+    # Tell a missing website apart from one owned by another client
+    if principal.role == 'client' and db.session.query(db.exists().where(Website.id == website_id)).scalar():
+        return None, {'message': 'Access denied'}, 403
+    
+    return None, {'message': 'Website not found'}, 404
 
-@analytics_bp.route('/analytics/<int:website_id>/overview', methods=['GET'])
-@jwt_required()
-def get_overview(website_id):
-    """Get overview analytics data for a website."""
+def parse_date_range():
+    """Return (start_date, end_date, error) from the query string, defaulting to the last 30 days."""
+    # Resolved once per request so every section agrees on "today"; kept on
+    # the request for the same reason as the websites in check_website_access
+    if 'analytics.date_range' in request.environ:
+        return request.environ['analytics.date_range']
+    
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    today = date.today()
+    
+    if not start_date:
+        start_date = (today - timedelta(days=30)).isoformat()
+    if not end_date:
+        end_date = today.isoformat()
+    
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
+        datetime.strptime(start_date, '%Y-%m-%d')
+        datetime.strptime(end_date, '%Y-%m-%d')
+        date_range = (start_date, end_date, None)
+    except ValueError:
+        date_range = (None, None, {'message': 'Dates must be in YYYY-MM-DD format'})
+    
+    request.environ['analytics.date_range'] = date_range
+    return date_range
+
+def website_access(f):
+    """Check the current user's access to the website before the view runs."""
+    @wraps(f)
+    def decorated_function(website_id, *args, **kwargs):
+        principal = current_principal()
         
-        if not user:
+        if not principal:
             return jsonify({'message': 'User not found'}), 404
         
-        website, error_response, status_code = check_website_access(user, website_id)
+        website, error_response, status_code = check_website_access(principal, website_id)
         if error_response:
             return jsonify(error_response), status_code
         
-        # Get date range from query parameters
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
-        
-        # Check cache first
-        cached_data = ga4_service.get_cached_data(
-            website_id, 'overview', start_date, end_date
-        )
-        
-        if cached_data:
-            return jsonify({
-                'website_id': website_id,
-                'domain': website.domain,
-                'date_range': {'start': start_date, 'end': end_date},
-                'data': cached_data,
-                'cached': True
-            }), 200
-        
-        # Fetch fresh data
-        if not website.ga4_property_id:
-            return jsonify({'message': 'GA4 property ID not configured for this website'}), 400
-        
-        data = ga4_service.get_overview_metrics(
-            website.ga4_property_id, start_date, end_date
-        )
-        
-        # Cache the data
-        ga4_service.cache_data(website_id, 'overview', data, start_date, end_date)
-        
-        return jsonify({
-            'website_id': website_id,
-            'domain': website.domain,
-            'date_range': {'start': start_date, 'end': end_date},
-            'data': data,
-            'cached': False
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'message': f'Failed to get overview data: {str(e)}'}), 500
+        return f(website_id, *args, website=website, **kwargs)
+    return decorated_function
+
+@analytics_bp.route('/analytics/<int:website_id>/metric/<metric>', methods=['GET'])
+@jwt_required()
+@website_access
+def get_metric(website_id, metric, website):
+    """Get one cached analytics report (overview, traffic_sources, page_performance) for a website."""
+    if metric not in METRIC_FETCHERS:
+        return jsonify({'message': f'Unknown metric: {metric}'}), 404
+    
+    return metric_response(website_id, website, metric)
+
+@analytics_bp.route('/analytics/<int:website_id>/overview', methods=['GET'])
+@jwt_required()
+@website_access
+def get_overview(website_id, website):
+    """Get overview analytics data for a website."""
+    return metric_response(website_id, website, 'overview')
 
 @analytics_bp.route('/analytics/<int:website_id>/traffic', methods=['GET'])
 @jwt_required()
-def get_traffic_data(website_id):
+@website_access
+def get_traffic_data(website_id, website):
     """Get traffic analytics data for a website."""
-    try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website, error_response, status_code = check_website_access(user, website_id)
-        if error_response:
-            return jsonify(error_response), status_code
-        
-        # Get date range from query parameters
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
-        
-        # Check cache first
-        cached_data = ga4_service.get_cached_data(
-            website_id, 'traffic_sources', start_date, end_date
-        )
-        
-        if cached_data:
-            return jsonify({
-                'website_id': website_id,
-                'domain': website.domain,
-                'date_range': {'start': start_date, 'end': end_date},
-                'data': cached_data,
-                'cached': True
-            }), 200
-        
-        # Fetch fresh data
-        if not website.ga4_property_id:
-            return jsonify({'message': 'GA4 property ID not configured for this website'}), 400
-        
-        data = ga4_service.get_traffic_sources(
-            website.ga4_property_id, start_date, end_date
-        )
-        
-        # Cache the data
-        ga4_service.cache_data(website_id, 'traffic_sources', data, start_date, end_date)
-        
-        return jsonify({
-            'website_id': website_id,
-            'domain': website.domain,
-            'date_range': {'start': start_date, 'end': end_date},
-            'data': data,
-            'cached': False
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'message': f'Failed to get traffic data: {str(e)}'}), 500
+    return metric_response(website_id, website, 'traffic_sources')
 
 @analytics_bp.route('/analytics/<int:website_id>/pages', methods=['GET'])
 @jwt_required()
-def get_page_performance(website_id):
+@website_access
+def get_page_performance(website_id, website):
     """Get page performance data for a website."""
+    return metric_response(website_id, website, 'page_performance')
+
+def metric_response(website_id, website, metric):
+    """Serve a metric from the cache, fetching and caching it from GA4 on a miss."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website, error_response, status_code = check_website_access(user, website_id)
-        if error_response:
-            return jsonify(error_response), status_code
-        
         # Get date range from query parameters
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
+        start_date, end_date, error_response = parse_date_range()
+        if error_response:
+            return jsonify(error_response), 400
         
         # Check cache first
         cached_data = ga4_service.get_cached_data(
-            website_id, 'page_performance', start_date, end_date
+            website_id, metric, start_date, end_date
         )
         
         if cached_data:
@@ -181,12 +151,12 @@ def get_page_performance(website_id):
         if not website.ga4_property_id:
             return jsonify({'message': 'GA4 property ID not configured for this website'}), 400
         
-        data = ga4_service.get_page_performance(
+        data = METRIC_FETCHERS[metric](
             website.ga4_property_id, start_date, end_date
         )
         
-        # Cache the data
-        ga4_service.cache_data(website_id, 'page_performance', data, start_date, end_date)
+        # Cache the data in the background
+        ga4_service.cache_data_async(website_id, metric, data, start_date, end_date)
         
         return jsonify({
             'website_id': website_id,
@@ -197,24 +167,15 @@ def get_page_performance(website_id):
         }), 200
         
     except Exception as e:
-        return jsonify({'message': f'Failed to get page performance data: {str(e)}'}), 500
+        return jsonify({'message': f'Failed to get {METRIC_LABELS[metric]}: {str(e)}'}), 500
 
 @analytics_bp.route('/analytics/<int:website_id>/realtime', methods=['GET'])
 @jwt_required()
-def get_realtime_data(website_id):
+@website_access
+def get_realtime_data(website_id, website):
     """Get real-time analytics data for a website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website, error_response, status_code = check_website_access(user, website_id)
-        if error_response:
-            return jsonify(error_response), status_code
-        
-        # Real-time data is never cached
+        # Real-time data skips the DB cache; ga4_service holds it for 30 seconds
         if not website.ga4_property_id:
             return jsonify({'message': 'GA4 property ID not configured for this website'}), 400
         
@@ -223,7 +184,7 @@ def get_realtime_data(website_id):
         return jsonify({
             'website_id': website_id,
             'domain': website.domain,
-            'timestamp': datetime.utcnow().isoformat(),
+            'timestamp': datetime.utcnow(),
             'data': data
         }), 200
         
@@ -232,27 +193,14 @@ def get_realtime_data(website_id):
 
 @analytics_bp.route('/analytics/<int:website_id>/dashboard', methods=['GET'])
 @jwt_required()
-def get_dashboard_data(website_id):
+@website_access
+def get_dashboard_data(website_id, website):
     """Get comprehensive dashboard data for a website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website, error_response, status_code = check_website_access(user, website_id)
-        if error_response:
-            return jsonify(error_response), status_code
-        
         # Get date range from query parameters
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
+        start_date, end_date, error_response = parse_date_range()
+        if error_response:
+            return jsonify(error_response), 400
         
         if not website.ga4_property_id:
             return jsonify({'message': 'GA4 property ID not configured for this website'}), 400
@@ -271,35 +219,25 @@ def get_dashboard_data(website_id):
             'realtime': None
         }
         
-        # Get overview data
-        cached_overview = ga4_service.get_cached_data(website_id, 'overview', start_date, end_date)
-        if cached_overview:
-            dashboard_data['overview'] = cached_overview
-        else:
-            overview_data = ga4_service.get_overview_metrics(website.ga4_property_id, start_date, end_date)
-            ga4_service.cache_data(website_id, 'overview', overview_data, start_date, end_date)
-            dashboard_data['overview'] = overview_data
-        
-        # Get traffic sources
-        cached_traffic = ga4_service.get_cached_data(website_id, 'traffic_sources', start_date, end_date)
-        if cached_traffic:
-            dashboard_data['traffic_sources'] = cached_traffic
-        else:
-            traffic_data = ga4_service.get_traffic_sources(website.ga4_property_id, start_date, end_date)
-            ga4_service.cache_data(website_id, 'traffic_sources', traffic_data, start_date, end_date)
-            dashboard_data['traffic_sources'] = traffic_data
-        
-        # Get page performance
-        cached_pages = ga4_service.get_cached_data(website_id, 'page_performance', start_date, end_date)
-        if cached_pages:
-            dashboard_data['page_performance'] = cached_pages
-        else:
-            pages_data = ga4_service.get_page_performance(website.ga4_property_id, start_date, end_date)
-            ga4_service.cache_data(website_id, 'page_performance', pages_data, start_date, end_date)
-            dashboard_data['page_performance'] = pages_data
-        
-        # Get real-time data (never cached)
-        dashboard_data['realtime'] = ga4_service.get_realtime_data(website.ga4_property_id)
+        # Serve cached sections from the DB in one query and fetch the misses
+        # from GA4 in one batch, alongside real-time data (not in the DB cache)
+        cached_sections = ga4_service.get_cached_data_many(website_id, list(METRIC_FETCHERS), start_date, end_date)
+        missing = []
+        for section in METRIC_FETCHERS:
+            cached_section = cached_sections.get(section)
+            if cached_section:
+                dashboard_data[section] = cached_section
+            else:
+                missing.append(section)
+        realtime_future = _ga4_pool.submit(ga4_service.get_realtime_data, website.ga4_property_id)
+        
+        if missing:
+            fetched = ga4_service.get_dashboard_bundle(website.ga4_property_id, start_date, end_date, missing)
+            for section, section_data in fetched.items():
+                ga4_service.cache_data_async(website_id, section, section_data, start_date, end_date)
+                dashboard_data[section] = section_data
+        
+        dashboard_data['realtime'] = realtime_future.result()
         
         return jsonify(dashboard_data), 200
         
@@ -308,25 +246,22 @@ def get_dashboard_data(website_id):
 
 @analytics_bp.route('/analytics/<int:website_id>/clear-cache', methods=['POST'])
 @jwt_required()
-def clear_cache(website_id):
+@website_access
+def clear_cache(website_id, website):
     """Clear cached analytics data for a website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website, error_response, status_code = check_website_access(user, website_id)
-        if error_response:
-            return jsonify(error_response), status_code
-        
-        # Clear all cached data for this website
-        deleted_count = db.session.query(GA4DataCache).filter(
-            GA4DataCache.website_id == website_id
-        ).delete()
+        # Clear all cached data for this website in one bulk DELETE,
+        # without loading rows or syncing the session
+        result = db.session.execute(
+            db.delete(GA4ResponseCache).where(GA4ResponseCache.website_id == website_id),
+            execution_options={'synchronize_session': False}
+        )
+        deleted_count = result.rowcount
         
         db.session.commit()
+        ga4_service.invalidate_cached_payloads(website_id)
+        if website.ga4_property_id:
+            ga4_service.invalidate(website.ga4_property_id)
         
         return jsonify({
             'message': f'Cleared {deleted_count} cached entries for website {website.domain}'
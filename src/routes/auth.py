@@ -3,8 +3,11 @@ from flask_jwt_extended import (
     create_access_token, create_refresh_token, jwt_required, 
     get_jwt_identity, get_jwt
 )
-from src.models.user import db, User, Client
-from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from src.models.user import db, User, Client, hash_password_async
+from src.utils.auth import get_user_cached, invalidate_user, revoke_token, token_claims
+from src.utils.validation import json_payload, normalize_email, CLIENT_CREATE_FIELDS
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -17,11 +20,14 @@ def login():
         if not data or not data.get('email') or not data.get('password'):
             return jsonify({'message': 'Email and password are required'}), 400
         
-        email = data.get('email').lower().strip()
+        email = normalize_email(data.get('email'))
         password = data.get('password')
         
-        # Find user by email
-        user = User.query.filter_by(email=email).first()
+        # Find user by email; the client profile comes from the same query
+        # and its websites, which login doesn't return, aren't loaded
+        user = User.query.options(
+            joinedload(User.client).lazyload(Client.websites)
+        ).filter_by(email=email).first()
         
         if not user or not user.check_password(password):
             return jsonify({'message': 'Invalid email or password'}), 401
@@ -29,9 +35,13 @@ def login():
         if not user.is_active:
             return jsonify({'message': 'Account is deactivated'}), 401
         
+        # Persist a password hash upgraded by check_password
+        if db.session.is_modified(user):
+            db.session.commit()
+        
         # Create tokens with string identity
-        access_token = create_access_token(identity=str(user.id))
-        refresh_token = create_refresh_token(identity=str(user.id))
+        access_token = create_access_token(identity=str(user.id), additional_claims=token_claims(user))
+        refresh_token = create_refresh_token(identity=str(user.id), additional_claims=token_claims(user))
         
         # Get client information if user is a client
         client_info = None
@@ -53,33 +63,29 @@ def login():
 def register():
     """User registration endpoint (admin only for creating client accounts)."""
     try:
-        data = request.get_json()
+        data, error = json_payload(CLIENT_CREATE_FIELDS)
+        if error:
+            return error
         
-        required_fields = ['email', 'password', 'full_name', 'company_name']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'message': f'{field} is required'}), 400
+        email = normalize_email(data.get('email'))
         
-        email = data.get('email').lower().strip()
+        # Hash in the background while the duplicate check runs
+        pending_hash = hash_password_async(data.get('password'))
         
         # Check if user already exists
-        if User.query.filter_by(email=email).first():
+        if db.session.query(db.exists().where(User.email == email)).scalar():
             return jsonify({'message': 'User with this email already exists'}), 409
         
-        # Create new user
         user = User(
             email=email,
             full_name=data.get('full_name'),
+            password_hash=pending_hash.result(),
             role='client'  # Default role for registration
         )
-        user.set_password(data.get('password'))
-        
-        db.session.add(user)
-        db.session.flush()  # Get user ID
         
-        # Create client profile
+        # Create client profile; the flush inserts the user first and fills in user_id
         client = Client(
-            user_id=user.id,
+            user=user,
             company_name=data.get('company_name'),
             contact_email=data.get('contact_email', email),
             phone=data.get('phone'),
@@ -88,20 +94,33 @@ def register():
         )
         
         db.session.add(client)
+        db.session.flush()
+        
+        # Serialize before commit so the response doesn't reload both rows
+        user_dict = user.to_dict()
+        client_dict = client.to_dict()
+        claims = token_claims(user)
+        
         db.session.commit()
+        invalidate_user(user_dict['id'])
         
-        # Create tokens
-        access_token = create_access_token(identity=user.id)
-        refresh_token = create_refresh_token(identity=user.id)
+        # Create tokens with string identity
+        access_token = create_access_token(identity=str(user_dict['id']), additional_claims=claims)
+        refresh_token = create_refresh_token(identity=str(user_dict['id']), additional_claims=claims)
         
         return jsonify({
             'message': 'Registration successful',
             'access_token': access_token,
             'refresh_token': refresh_token,
-            'user': user.to_dict(),
-            'client': client.to_dict()
+            'user': user_dict,
+            'client': client_dict
         }), 201
         
+    except IntegrityError:
+        # Another request took the email between the check and the write
+        db.session.rollback()
+        return jsonify({'message': 'User with this email already exists'}), 409
+        
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Registration failed: {str(e)}'}), 500
@@ -112,12 +131,12 @@ def refresh():
     """Refresh access token."""
     try:
         current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
+        cached = get_user_cached(current_user_id)
         
-        if not user or not user.is_active:
+        if not cached or not cached['user']['is_active']:
             return jsonify({'message': 'User not found or inactive'}), 404
         
-        new_access_token = create_access_token(identity=current_user_id)
+        new_access_token = create_access_token(identity=str(current_user_id), additional_claims=cached['claims'])
         
         return jsonify({
             'access_token': new_access_token
@@ -132,18 +151,18 @@ def get_profile():
     """Get current user profile."""
     try:
         current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
+        cached = get_user_cached(current_user_id)
         
-        if not user:
+        if not cached:
             return jsonify({'message': 'User not found'}), 404
         
         # Get client information if user is a client
         client_info = None
-        if user.role == 'client' and user.client:
-            client_info = user.client.to_dict()
+        if cached['user']['role'] == 'client':
+            client_info = cached['client']
         
         return jsonify({
-            'user': user.to_dict(),
+            'user': cached['user'],
             'client': client_info
         }), 200
         
@@ -156,21 +175,27 @@ def update_profile():
     """Update current user profile."""
     try:
         current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
+        user = db.session.get(
+            User, current_user_id, options=[joinedload(User.client).lazyload(Client.websites)]
+        )
         
         if not user:
             return jsonify({'message': 'User not found'}), 404
         
         data = request.get_json()
+        pending_hash = hash_password_async(data['password']) if data.get('password') else None
         
         # Update user fields
         if 'full_name' in data:
             user.full_name = data['full_name']
         
-        if 'password' in data and data['password']:
-            user.set_password(data['password'])
+        claims = None
+        if pending_hash:
+            # As in change_password: revoke every token issued before the change
+            user.password_hash = pending_hash.result()
+            user.token_version += 1
+            claims = token_claims(user)
         
-        user.updated_at = datetime.utcnow()
         
         # Update client fields if user is a client
         if user.role == 'client' and user.client:
@@ -185,20 +210,26 @@ def update_profile():
             if 'address' in data:
                 client.address = data['address']
             
-            client.updated_at = datetime.utcnow()
         
         db.session.commit()
+        invalidate_user(user.id)
         
         # Get updated client information
         client_info = None
         if user.role == 'client' and user.client:
             client_info = user.client.to_dict()
         
-        return jsonify({
+        response = {
             'message': 'Profile updated successfully',
             'user': user.to_dict(),
             'client': client_info
-        }), 200
+        }
+        if claims:
+            # This session carries on with tokens for the new version
+            response['access_token'] = create_access_token(identity=str(user.id), additional_claims=claims)
+            response['refresh_token'] = create_refresh_token(identity=str(user.id), additional_claims=claims)
+        
+        return jsonify(response), 200
         
     except Exception as e:
         db.session.rollback()
@@ -208,9 +239,13 @@ def update_profile():
 @jwt_required()
 def logout():
     """User logout endpoint."""
-    # In a production environment, you might want to blacklist the token
-    # For now, we'll just return a success message
-    return jsonify({'message': 'Logout successful'}), 200
+    try:
+        # Revoke the access token used to log out
+        revoke_token(get_jwt())
+        return jsonify({'message': 'Logout successful'}), 200
+        
+    except Exception as e:
+        return jsonify({'message': f'Logout failed: {str(e)}'}), 500
 
 @auth_bp.route('/change-password', methods=['POST'])
 @jwt_required()
@@ -218,7 +253,10 @@ def change_password():
     """Change user password."""
     try:
         current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
+        # The client profile is only needed for the new tokens' claims
+        user = db.session.get(
+            User, current_user_id, options=[joinedload(User.client).lazyload(Client.websites)]
+        )
         
         if not user:
             return jsonify({'message': 'User not found'}), 404
@@ -228,17 +266,27 @@ def change_password():
         if not data.get('current_password') or not data.get('new_password'):
             return jsonify({'message': 'Current password and new password are required'}), 400
         
-        # Verify current password
-        if not user.check_password(data['current_password']):
+        # Hash the new password while the current one is verified
+        pending_hash = hash_password_async(data['new_password'])
+        
+        # Verify current password; the hash is replaced below, so don't upgrade it
+        if not user.check_password(data['current_password'], upgrade=False):
             return jsonify({'message': 'Current password is incorrect'}), 401
         
-        # Update password
-        user.set_password(data['new_password'])
-        user.updated_at = datetime.utcnow()
+        # Update password and revoke every token issued before the change
+        user.password_hash = pending_hash.result()
+        user.token_version += 1
         
+        # This session carries on with tokens for the new version
+        claims = token_claims(user)
         db.session.commit()
+        invalidate_user(current_user_id)
         
-        return jsonify({'message': 'Password changed successfully'}), 200
+        return jsonify({
+            'message': 'Password changed successfully',
+            'access_token': create_access_token(identity=str(current_user_id), additional_claims=claims),
+            'refresh_token': create_refresh_token(identity=str(current_user_id), additional_claims=claims)
+        }), 200
         
     except Exception as e:
         db.session.rollback()
@@ -1,15 +1,109 @@
-from flask import Blueprint, request, jsonify, redirect, session
+from flask import Blueprint, request, jsonify, redirect
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from src.models.user import db, User, GA4Account, GA4Property
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import contains_eager
+from src.models.user import db, User, GA4Account, GA4Property, utcnow
 from src.services.ga4_oauth import GA4OAuthService
 from src.services.ga4_data import GA4DataService
-from datetime import datetime
+from src.utils.cache import cache, cache_take, ga4_token_key, oauth_state_key, oauth_tokens_key
+from src.utils.loading import strict_loading
+from src.utils.executor import WorkerPool
+from datetime import datetime, timedelta
+import logging
 import secrets
+import time
 
 ga4_bp = Blueprint('ga4', __name__)
+logger = logging.getLogger(__name__)
 oauth_service = GA4OAuthService()
 data_service = GA4DataService()
 
+# How long an OAuth flow may take, from start to complete
+OAUTH_FLOW_TIMEOUT = 600
+
+# Google API calls that can overlap the request's database work
+_google_pool = WorkerPool(max_workers=4, thread_name_prefix='google-api')
+
+# Columns of GA4Account.to_dict and GA4Property.to_dict, for list
+# endpoints that read plain rows instead of ORM instances
+ACCOUNT_COLUMNS = ('id', 'user_id', 'google_account_id', 'email', 'is_active', 'created_at', 'updated_at')
+PROPERTY_COLUMNS = (
+    'id', 'account_id', 'property_id', 'property_name', 'website_url',
+    'is_active', 'created_at', 'updated_at'
+)
+
+# Access tokens are refreshed this long before Google expires them
+TOKEN_REFRESH_MARGIN = timedelta(seconds=60)
+# How long one request may hold the refresh lock for an account
+TOKEN_REFRESH_LOCK_TIMEOUT = 30
+
+def _get_property_for_user(property_id, user_id):
+    """Return the user's active property with its account loaded from the same JOIN, or None."""
+    return db.session.scalar(strict_loading(
+        db.select(GA4Property)
+        .join(GA4Property.account)
+        .where(
+            GA4Property.property_id == property_id,
+            GA4Account.user_id == user_id,
+            GA4Property.is_active == True,
+            GA4Account.is_active == True
+        )
+        .options(contains_eager(GA4Property.account))
+        .limit(1)
+    ))
+
+def _get_access_token(account):
+    """Return a usable Google access token for the account, refreshing it when it is about to expire."""
+    key = ga4_token_key(account.id)
+    cached = cache.get(key)
+    if cached and _token_fresh(cached['expires_at']):
+        return cached['access_token']
+    
+    if _token_fresh(account.token_expires_at):
+        token = {'access_token': account.access_token, 'expires_at': account.token_expires_at}
+    else:
+        token = _refresh_access_token(account)
+    
+    _cache_token(key, token)
+    return token['access_token']
+
+def _token_fresh(expires_at):
+    return expires_at is not None and expires_at - TOKEN_REFRESH_MARGIN > datetime.utcnow()
+
+def _cache_token(key, token):
+    ttl = (token['expires_at'] - TOKEN_REFRESH_MARGIN - datetime.utcnow()).total_seconds()
+    if ttl > 0:
+        cache.set(key, token, timeout=int(ttl))
+
+def _refresh_access_token(account):
+    """Refresh the account's token with Google, once across concurrent requests."""
+    key = ga4_token_key(account.id)
+    lock_key = f'{key}:refreshing'
+    
+    # Whoever adds the lock refreshes; the others wait for its result and
+    # only refresh themselves if it doesn't arrive
+    locked = cache.add(lock_key, 1, timeout=TOKEN_REFRESH_LOCK_TIMEOUT)
+    if not locked:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            cached = cache.get(key)
+            if cached and _token_fresh(cached['expires_at']):
+                return cached
+    
+    try:
+        # Google returns naive UTC expiries, matching token_expires_at
+        token = oauth_service.refresh_access_token(account.refresh_token)
+        account.access_token = token['access_token']
+        account.token_expires_at = token['expires_at']
+        db.session.commit()
+        _cache_token(key, token)
+        return token
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
 @ga4_bp.route('/auth/google/start', methods=['POST'])
 @jwt_required()
 def start_google_auth():
@@ -19,8 +113,8 @@ def start_google_auth():
     # Generate state parameter for security
     state = secrets.token_urlsafe(32)
     
-    # Store state in session (you might want to use Redis for production)
-    session[f'oauth_state_{user_id}'] = state
+    # Remember whose flow this is; the callback carries only the state
+    cache.set(oauth_state_key(state), user_id, timeout=OAUTH_FLOW_TIMEOUT)
     
     authorization_url, _ = oauth_service.get_authorization_url(state=state)
     
@@ -42,6 +136,11 @@ def google_auth_callback():
     if not code or not state:
         return redirect("https://app.mysitemetrics.io/ga4-connect?error=missing_parameters")
     
+    # Each state is good for one callback
+    user_id = cache_take(oauth_state_key(state))
+    if user_id is None:
+        return redirect("https://app.mysitemetrics.io/ga4-connect?error=invalid_state")
+    
     try:
         # Exchange code for tokens
         token_data = oauth_service.exchange_code_for_tokens(code, state)
@@ -51,20 +150,21 @@ def google_auth_callback():
         google_account_id = user_info['id']
         email = user_info['email']
         
-        # Store the tokens temporarily in session for the frontend to process
-        # In production, you'd want to associate this with the authenticated user
-        session['temp_ga4_tokens'] = {
+        # Hold the tokens server-side for the user who started the flow
+        # until the frontend completes the connection
+        cache.set(oauth_tokens_key(user_id), {
             'access_token': token_data['access_token'],
             'refresh_token': token_data['refresh_token'],
-            'expires_at': token_data['expires_at'].isoformat() if token_data['expires_at'] else None,
+            # The cache pickles values, so the expiry stays a datetime
+            'expires_at': token_data['expires_at'],
             'google_account_id': google_account_id,
             'email': email
-        }
+        }, timeout=OAUTH_FLOW_TIMEOUT)
         
         return redirect(f"https://app.mysitemetrics.io/ga4-connect?success=true&email={email}")
         
-    except Exception as e:
-        print(f"OAuth callback error: {str(e)}")
+    except Exception:
+        logger.exception("OAuth callback error")
         return redirect(f"https://app.mysitemetrics.io/ga4-connect?error=oauth_failed")
 
 @ga4_bp.route('/auth/google/complete', methods=['POST'])
@@ -73,12 +173,18 @@ def complete_google_auth():
     """Complete the GA4 account connection process"""
     user_id = get_jwt_identity()
     
-    # Get tokens from session
-    temp_tokens = session.get('temp_ga4_tokens')
+    # Take the tokens left by the OAuth callback
+    temp_tokens = cache_take(oauth_tokens_key(user_id))
     if not temp_tokens:
         return jsonify({'error': 'No authentication data found'}), 400
     
     try:
+        # The property listing is a slow Google API call that doesn't depend
+        # on the account row, so it runs while the account is saved
+        pending_properties = _google_pool.submit(
+            oauth_service.get_analytics_properties, temp_tokens['access_token']
+        )
+        
         # Check if account already exists
         existing_account = GA4Account.query.filter_by(
             user_id=user_id,
@@ -89,9 +195,8 @@ def complete_google_auth():
             # Update existing account
             existing_account.access_token = temp_tokens['access_token']
             existing_account.refresh_token = temp_tokens['refresh_token']
-            existing_account.token_expires_at = datetime.fromisoformat(temp_tokens['expires_at']) if temp_tokens['expires_at'] else None
+            existing_account.token_expires_at = temp_tokens['expires_at']
             existing_account.is_active = True
-            existing_account.updated_at = datetime.utcnow()
             
             account = existing_account
         else:
@@ -102,51 +207,56 @@ def complete_google_auth():
                 email=temp_tokens['email'],
                 access_token=temp_tokens['access_token'],
                 refresh_token=temp_tokens['refresh_token'],
-                token_expires_at=datetime.fromisoformat(temp_tokens['expires_at']) if temp_tokens['expires_at'] else None
+                token_expires_at=temp_tokens['expires_at']
             )
             db.session.add(account)
         
         db.session.commit()
+        # Stop serving the replaced access token
+        cache.delete(ga4_token_key(account.id))
         
-        # Fetch and store GA4 properties
-        properties = oauth_service.get_analytics_properties(temp_tokens['access_token'])
+        # Store the fetched GA4 properties
+        properties = pending_properties.result()
         
-        for prop_data in properties:
-            existing_property = GA4Property.query.filter_by(
-                account_id=account.id,
-                property_id=prop_data['property_id']
-            ).first()
-            
-            if existing_property:
-                # Update existing property
-                existing_property.property_name = prop_data['property_name']
-                existing_property.website_url = prop_data['website_url']
-                existing_property.is_active = True
-                existing_property.updated_at = datetime.utcnow()
-            else:
-                # Create new property
-                new_property = GA4Property(
-                    account_id=account.id,
-                    property_id=prop_data['property_id'],
-                    property_name=prop_data['property_name'],
-                    website_url=prop_data['website_url']
-                )
-                db.session.add(new_property)
+        # Insert new properties and refresh existing ones in one statement
+        if properties:
+            # One row per property; a repeated id can't be upserted twice in one statement
+            rows = {
+                prop_data['property_id']: {
+                    'account_id': account.id,
+                    'property_id': prop_data['property_id'],
+                    'property_name': prop_data['property_name'],
+                    'website_url': prop_data['website_url'],
+                    'is_active': True
+                }
+                for prop_data in properties
+            }
+            insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+            stmt = insert(GA4Property).values(list(rows.values()))
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['account_id', 'property_id'],
+                set_={
+                    'property_name': stmt.excluded.property_name,
+                    'website_url': stmt.excluded.website_url,
+                    'is_active': True,
+                    # ON CONFLICT's SET doesn't apply the column's onupdate
+                    'updated_at': utcnow()
+                }
+            ))
         
         db.session.commit()
         
-        # Clear temporary tokens
-        session.pop('temp_ga4_tokens', None)
-        
         return jsonify({
             'success': True,
             'account': account.to_dict(),
             'properties_count': len(properties)
         })
         
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"Complete auth error: {str(e)}")
+        # Put the tokens back so the user can retry without a new OAuth flow
+        cache.set(oauth_tokens_key(user_id), temp_tokens, timeout=OAUTH_FLOW_TIMEOUT)
+        logger.exception("Complete auth error")
         return jsonify({'error': 'Failed to complete authentication'}), 500
 
 @ga4_bp.route('/accounts', methods=['GET'])
@@ -155,16 +265,20 @@ def get_ga4_accounts():
     """Get user's connected GA4 accounts"""
     user_id = get_jwt_identity()
     
-    accounts = GA4Account.query.filter_by(user_id=user_id, is_active=True).all()
-    
-    accounts_data = []
-    for account in accounts:
-        account_dict = account.to_dict()
-        account_dict['properties_count'] = len(account.properties)
-        accounts_data.append(account_dict)
+    # Plain rows with the property count from the same query; the response
+    # is dicts anyway, so ORM instances would only add overhead
+    accounts = db.session.execute(
+        db.select(
+            *[getattr(GA4Account, name) for name in ACCOUNT_COLUMNS],
+            db.func.count(GA4Property.id).label('properties_count')
+        )
+        .outerjoin(GA4Account.properties)
+        .where(GA4Account.user_id == user_id, GA4Account.is_active == True)
+        .group_by(GA4Account.id)
+    ).mappings()
     
     return jsonify({
-        'accounts': accounts_data
+        'accounts': [dict(account) for account in accounts]
     })
 
 @ga4_bp.route('/accounts/<int:account_id>/properties', methods=['GET'])
@@ -174,23 +288,22 @@ def get_account_properties(account_id):
     user_id = get_jwt_identity()
     
     # Verify account belongs to user
-    account = GA4Account.query.filter_by(
-        id=account_id, 
-        user_id=user_id, 
-        is_active=True
-    ).first()
+    account = db.session.execute(
+        db.select(*[getattr(GA4Account, name) for name in ACCOUNT_COLUMNS])
+        .where(GA4Account.id == account_id, GA4Account.user_id == user_id, GA4Account.is_active == True)
+    ).mappings().first()
     
     if not account:
         return jsonify({'error': 'Account not found'}), 404
     
-    properties = GA4Property.query.filter_by(
-        account_id=account_id, 
-        is_active=True
-    ).all()
+    properties = db.session.execute(
+        db.select(*[getattr(GA4Property, name) for name in PROPERTY_COLUMNS])
+        .where(GA4Property.account_id == account_id, GA4Property.is_active == True)
+    ).mappings()
     
     return jsonify({
-        'account': account.to_dict(),
-        'properties': [prop.to_dict() for prop in properties]
+        'account': dict(account),
+        'properties': [dict(prop) for prop in properties]
     })
 
 @ga4_bp.route('/properties/<property_id>/analytics', methods=['GET'])
@@ -200,12 +313,7 @@ def get_property_analytics(property_id):
     user_id = get_jwt_identity()
     
     # Find the property and verify user access
-    property_obj = db.session.query(GA4Property).join(GA4Account).filter(
-        GA4Property.property_id == property_id,
-        GA4Account.user_id == user_id,
-        GA4Property.is_active == True,
-        GA4Account.is_active == True
-    ).first()
+    property_obj = _get_property_for_user(property_id, user_id)
     
     if not property_obj:
         return jsonify({'error': 'Property not found or access denied'}), 404
@@ -215,9 +323,8 @@ def get_property_analytics(property_id):
     end_date = request.args.get('end_date')
     
     try:
-        # Get fresh access token (implement token refresh logic)
-        account = property_obj.account
-        access_token = account.access_token  # You'll need to implement token refresh
+        # The account was loaded with the property
+        access_token = _get_access_token(property_obj.account)
         
         # Fetch analytics data
         analytics_data = data_service.get_analytics_data(
@@ -229,8 +336,8 @@ def get_property_analytics(property_id):
         
         return jsonify(analytics_data)
         
-    except Exception as e:
-        print(f"Analytics data error: {str(e)}")
+    except Exception:
+        logger.exception("Analytics data error")
         return jsonify({'error': 'Failed to fetch analytics data'}), 500
 
 @ga4_bp.route('/properties/<property_id>/realtime', methods=['GET'])
@@ -240,28 +347,22 @@ def get_property_realtime(property_id):
     user_id = get_jwt_identity()
     
     # Find the property and verify user access
-    property_obj = db.session.query(GA4Property).join(GA4Account).filter(
-        GA4Property.property_id == property_id,
-        GA4Account.user_id == user_id,
-        GA4Property.is_active == True,
-        GA4Account.is_active == True
-    ).first()
+    property_obj = _get_property_for_user(property_id, user_id)
     
     if not property_obj:
         return jsonify({'error': 'Property not found or access denied'}), 404
     
     try:
         # Get fresh access token
-        account = property_obj.account
-        access_token = account.access_token
+        access_token = _get_access_token(property_obj.account)
         
         # Fetch real-time data
         realtime_data = data_service.get_real_time_data(access_token, property_id)
         
         return jsonify(realtime_data)
         
-    except Exception as e:
-        print(f"Real-time data error: {str(e)}")
+    except Exception:
+        logger.exception("Real-time data error")
         return jsonify({'error': 'Failed to fetch real-time data'}), 500
 
 @ga4_bp.route('/properties/<property_id>/pages', methods=['GET'])
@@ -271,12 +372,7 @@ def get_property_pages(property_id):
     user_id = get_jwt_identity()
     
     # Find the property and verify user access
-    property_obj = db.session.query(GA4Property).join(GA4Account).filter(
-        GA4Property.property_id == property_id,
-        GA4Account.user_id == user_id,
-        GA4Property.is_active == True,
-        GA4Account.is_active == True
-    ).first()
+    property_obj = _get_property_for_user(property_id, user_id)
     
     if not property_obj:
         return jsonify({'error': 'Property not found or access denied'}), 404
@@ -287,8 +383,7 @@ def get_property_pages(property_id):
     
     try:
         # Get fresh access token
-        account = property_obj.account
-        access_token = account.access_token
+        access_token = _get_access_token(property_obj.account)
         
         # Fetch pages data
         pages_data = data_service.get_top_pages(
@@ -300,8 +395,8 @@ def get_property_pages(property_id):
         
         return jsonify({'pages': pages_data})
         
-    except Exception as e:
-        print(f"Pages data error: {str(e)}")
+    except Exception:
+        logger.exception("Pages data error")
         return jsonify({'error': 'Failed to fetch pages data'}), 500
 
 @ga4_bp.route('/properties/<property_id>/traffic-sources', methods=['GET'])
@@ -311,12 +406,7 @@ def get_property_traffic_sources(property_id):
     user_id = get_jwt_identity()
     
     # Find the property and verify user access
-    property_obj = db.session.query(GA4Property).join(GA4Account).filter(
-        GA4Property.property_id == property_id,
-        GA4Account.user_id == user_id,
-        GA4Property.is_active == True,
-        GA4Account.is_active == True
-    ).first()
+    property_obj = _get_property_for_user(property_id, user_id)
     
     if not property_obj:
         return jsonify({'error': 'Property not found or access denied'}), 404
@@ -327,8 +417,7 @@ def get_property_traffic_sources(property_id):
     
     try:
         # Get fresh access token
-        account = property_obj.account
-        access_token = account.access_token
+        access_token = _get_access_token(property_obj.account)
         
         # Fetch traffic sources data
         sources_data = data_service.get_traffic_sources(
@@ -340,10 +429,43 @@ def get_property_traffic_sources(property_id):
         
         return jsonify({'sources': sources_data})
         
-    except Exception as e:
-        print(f"Traffic sources data error: {str(e)}")
+    except Exception:
+        logger.exception("Traffic sources data error")
         return jsonify({'error': 'Failed to fetch traffic sources data'}), 500
 
+@ga4_bp.route('/properties/<property_id>/dashboard', methods=['GET'])
+@jwt_required()
+def get_property_dashboard(property_id):
+    """Get analytics, real-time, pages and traffic sources data for a property in one call"""
+    user_id = get_jwt_identity()
+    
+    # Find the property and verify user access
+    property_obj = _get_property_for_user(property_id, user_id)
+    
+    if not property_obj:
+        return jsonify({'error': 'Property not found or access denied'}), 404
+    
+    # Get date range from query parameters
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    
+    try:
+        access_token = _get_access_token(property_obj.account)
+        
+        # Three reports in one batch request, with real-time data fetched alongside
+        dashboard_data = data_service.get_dashboard_batch(
+            access_token, 
+            property_id, 
+            start_date, 
+            end_date
+        )
+        
+        return jsonify(dashboard_data)
+        
+    except Exception:
+        logger.exception("Dashboard data error")
+        return jsonify({'error': 'Failed to fetch dashboard data'}), 500
+
 @ga4_bp.route('/accounts/<int:account_id>/disconnect', methods=['DELETE'])
 @jwt_required()
 def disconnect_ga4_account(account_id):
@@ -361,17 +483,22 @@ def disconnect_ga4_account(account_id):
         return jsonify({'error': 'Account not found'}), 404
     
     try:
-        # Deactivate account and properties
+        # Deactivate account and properties; the properties in one UPDATE
+        # without loading the collection
         account.is_active = False
-        for property_obj in account.properties:
-            property_obj.is_active = False
+        db.session.execute(
+            db.update(GA4Property)
+            .where(GA4Property.account_id == account.id)
+            .values(is_active=False),
+            execution_options={'synchronize_session': False}
+        )
         
         db.session.commit()
         
         return jsonify({'success': True, 'message': 'Account disconnected successfully'})
         
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"Disconnect error: {str(e)}")
+        logger.exception("Disconnect error")
         return jsonify({'error': 'Failed to disconnect account'}), 500
 
@@ -1,38 +1,64 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from src.models.user import db, User, Website, Client
-from datetime import datetime
+from flask import Blueprint, current_app, request, jsonify
+from flask_jwt_extended import jwt_required
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, lazyload
+from src.models.user import db, Website, Client, utcnow
+from src.utils.auth import with_principal
+from src.utils.loading import strict_loading
 
 websites_bp = Blueprint('websites', __name__)
 
+# Fields any user may change on their websites; is_active is admin-only
+WEBSITE_UPDATE_FIELDS = ('domain', 'ga4_property_id', 'search_console_url')
+
+# Columns of the website list, in Website.to_dict() and Client.to_dict() order
+WEBSITE_COLUMNS = (
+    'id', 'client_id', 'domain', 'ga4_property_id', 'search_console_url',
+    'is_active', 'created_at', 'updated_at'
+)
+CLIENT_COLUMNS = (
+    'id', 'user_id', 'company_name', 'contact_email', 'phone', 'address',
+    'subscription_plan', 'is_active', 'created_at', 'updated_at'
+)
+
+def _get_website(website_id, principal):
+    """Load a website; for admins, whose responses include the client, with the client from the same query."""
+    query = Website.query.filter_by(id=website_id)
+    if principal.role == 'admin':
+        query = query.options(joinedload(Website.client).options(lazyload(Client.user), lazyload(Client.websites)))
+    return strict_loading(query).first()
+
 @websites_bp.route('/websites', methods=['GET'])
 @jwt_required()
-def get_websites():
+@with_principal
+def get_websites(principal):
     """Get all websites for the current user."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        if user.role == 'admin':
-            # Admin can see all websites
-            websites = Website.query.all()
-        elif user.role == 'client' and user.client:
+        website_columns = [getattr(Website, name) for name in WEBSITE_COLUMNS]
+        
+        # Plain rows rather than ORM objects; each dict has the same keys as to_dict()
+        if principal.role == 'admin':
+            # Admin can see all websites, each with its client from the same JOIN
+            rows = db.session.execute(
+                db.select(*website_columns, *[getattr(Client, name) for name in CLIENT_COLUMNS])
+                .join(Website.client)
+            ).all()
+            
+            split = len(WEBSITE_COLUMNS)
+            websites_data = []
+            for row in rows:
+                website_dict = dict(zip(WEBSITE_COLUMNS, row[:split]))
+                website_dict['client'] = dict(zip(CLIENT_COLUMNS, row[split:]))
+                websites_data.append(website_dict)
+        elif principal.role == 'client' and principal.client_id:
             # Client can only see their own websites
-            websites = user.client.websites
+            rows = db.session.execute(
+                db.select(*website_columns).where(Website.client_id == principal.client_id)
+            ).all()
+            websites_data = [dict(zip(WEBSITE_COLUMNS, row)) for row in rows]
         else:
             return jsonify({'message': 'Access denied'}), 403
         
-        websites_data = []
-        for website in websites:
-            website_dict = website.to_dict()
-            # Add client information for admin users
-            if user.role == 'admin':
-                website_dict['client'] = website.client.to_dict()
-            websites_data.append(website_dict)
-        
         return jsonify({
             'websites': websites_data,
             'total': len(websites_data)
@@ -43,15 +69,10 @@ def get_websites():
 
 @websites_bp.route('/websites', methods=['POST'])
 @jwt_required()
-def create_website():
+@with_principal
+def create_website(principal):
     """Create a new website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
         data = request.get_json()
         
         if not data.get('domain'):
@@ -59,30 +80,27 @@ def create_website():
         
         # Determine client_id
         client_id = None
-        if user.role == 'admin':
+        if principal.role == 'admin':
             # Admin can create websites for any client
             client_id = data.get('client_id')
             if not client_id:
                 return jsonify({'message': 'client_id is required for admin users'}), 400
             
             # Verify client exists
-            client = Client.query.get(client_id)
+            client = db.session.get(Client, client_id)
             if not client:
                 return jsonify({'message': 'Client not found'}), 404
                 
-        elif user.role == 'client' and user.client:
+        elif principal.role == 'client' and principal.client_id:
             # Client creates website for themselves
-            client_id = user.client.id
+            client_id = principal.client_id
         else:
             return jsonify({'message': 'Access denied'}), 403
         
-        # Check if domain already exists for this client
-        existing_website = Website.query.filter_by(
-            client_id=client_id, 
-            domain=data['domain']
-        ).first()
-        
-        if existing_website:
+        # The unique (client_id, domain) index rejects duplicates, once it exists
+        if not current_app.config.get('WEBSITE_DOMAIN_INDEX') and db.session.query(db.exists().where(
+            Website.client_id == client_id, Website.domain == data['domain']
+        )).scalar():
             return jsonify({'message': 'Website with this domain already exists for this client'}), 409
         
         # Create new website
@@ -97,7 +115,7 @@ def create_website():
         db.session.commit()
         
         website_dict = website.to_dict()
-        if user.role == 'admin':
+        if principal.role == 'admin':
             website_dict['client'] = website.client.to_dict()
         
         return jsonify({
@@ -105,32 +123,140 @@ def create_website():
             'website': website_dict
         }), 201
         
+    except IntegrityError:
+        # The client already has a website with this domain
+        db.session.rollback()
+        return jsonify({'message': 'Website with this domain already exists for this client'}), 409
+        
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Failed to create website: {str(e)}'}), 500
 
-@websites_bp.route('/websites/<int:website_id>', methods=['GET'])
+@websites_bp.route('/websites/bulk', methods=['POST'])
 @jwt_required()
-def get_website(website_id):
-    """Get a specific website."""
+@with_principal
+def create_websites_bulk(principal):
+    """Create several websites at once; domains a client already has are skipped."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
+        data = request.get_json(silent=True)
+        items = data.get('websites') if isinstance(data, dict) else None
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'message': 'websites must be a non-empty list'}), 400
+        
+        if not all(isinstance(item, dict) and item.get('domain') for item in items):
+            return jsonify({'message': 'Domain is required for every website'}), 400
         
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
+        if not all(isinstance(item['domain'], str) for item in items):
+            return jsonify({'message': 'Domain must be a string'}), 400
         
-        website = Website.query.get(website_id)
+        clients = {}
+        if principal.role == 'admin':
+            # Admin can create websites for any client
+            if not all(item.get('client_id') for item in items):
+                return jsonify({'message': 'client_id is required for admin users'}), 400
+            
+            # Client ids may arrive as strings; the lookup below is by integer id
+            try:
+                items = [dict(item, client_id=int(item['client_id'])) for item in items]
+            except (TypeError, ValueError):
+                return jsonify({'message': 'client_id must be an integer'}), 400
+            
+            # Verify every client exists in one query; the created websites'
+            # client comes from the identity map when serializing
+            client_ids = {item['client_id'] for item in items}
+            clients = {
+                client.id: client
+                for client in Client.query.options(lazyload(Client.user), lazyload(Client.websites))
+                .filter(Client.id.in_(client_ids))
+            }
+            missing = client_ids - clients.keys()
+            if missing:
+                return jsonify({'message': f'Client not found: {", ".join(map(str, sorted(missing)))}'}), 404
+            
+        elif principal.role == 'client' and principal.client_id:
+            # Client creates websites for themselves
+            items = [dict(item, client_id=principal.client_id) for item in items]
+        else:
+            return jsonify({'message': 'Access denied'}), 403
+        
+        # A domain listed twice is created once, from its first entry; the
+        # repeats are reported as skipped
+        incoming = {}
+        repeated = []
+        for item in items:
+            key = (item['client_id'], item['domain'])
+            if key in incoming:
+                repeated.append(key)
+            else:
+                incoming[key] = item
+        
+        # Check every domain in one query
+        existing = set(
+            db.session.query(Website.client_id, Website.domain)
+            .filter(db.tuple_(Website.client_id, Website.domain).in_(list(incoming)))
+            .all()
+        )
+        
+        websites = [
+            Website(
+                client_id=client_id,
+                domain=domain,
+                ga4_property_id=item.get('ga4_property_id'),
+                search_console_url=item.get('search_console_url')
+            )
+            for (client_id, domain), item in incoming.items()
+            if (client_id, domain) not in existing
+        ]
+        
+        # One flush inserts them all
+        db.session.add_all(websites)
+        db.session.flush()
+        
+        websites_data = []
+        for website in websites:
+            website_dict = website.to_dict()
+            if principal.role == 'admin':
+                website_dict['client'] = clients[website.client_id].to_dict()
+            websites_data.append(website_dict)
+        
+        db.session.commit()
+        
+        return jsonify({
+            'message': f'Created {len(websites_data)} websites',
+            'websites': websites_data,
+            'skipped': [
+                {'client_id': client_id, 'domain': domain} for client_id, domain in sorted(existing) + repeated
+            ],
+            'total': len(websites_data)
+        }), 201 if websites_data else 200
+        
+    except IntegrityError:
+        # Another request added one of the domains between the check and the write
+        db.session.rollback()
+        return jsonify({'message': 'Website with this domain already exists for this client'}), 409
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Failed to create websites: {str(e)}'}), 500
+
+@websites_bp.route('/websites/<int:website_id>', methods=['GET'])
+@jwt_required()
+@with_principal
+def get_website(website_id, principal):
+    """Get a specific website."""
+    try:
+        website = _get_website(website_id, principal)
         if not website:
             return jsonify({'message': 'Website not found'}), 404
         
         # Check permissions
-        if user.role == 'client':
-            if not user.client or website.client_id != user.client.id:
+        if principal.role == 'client':
+            if website.client_id != principal.client_id:
                 return jsonify({'message': 'Access denied'}), 403
         
         website_dict = website.to_dict()
-        if user.role == 'admin':
+        if principal.role == 'admin':
             website_dict['client'] = website.client.to_dict()
         
         return jsonify({'website': website_dict}), 200
@@ -140,89 +266,86 @@ def get_website(website_id):
 
 @websites_bp.route('/websites/<int:website_id>', methods=['PUT'])
 @jwt_required()
-def update_website(website_id):
+@with_principal
+def update_website(website_id, principal):
     """Update a website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website = Website.query.get(website_id)
-        if not website:
-            return jsonify({'message': 'Website not found'}), 404
-        
-        # Check permissions
-        if user.role == 'client':
-            if not user.client or website.client_id != user.client.id:
-                return jsonify({'message': 'Access denied'}), 403
-        
         data = request.get_json()
+        is_admin = principal.role == 'admin'
+        
+        # Update fields; stamp updated_at even when no listed field is given
+        values = {field: data[field] for field in WEBSITE_UPDATE_FIELDS if field in data}
+        if 'is_active' in data and is_admin:
+            values['is_active'] = data['is_active']
+        values['updated_at'] = utcnow()
+        
+        # The permission check is part of the UPDATE and the unique
+        # (client_id, domain) index rejects a domain conflict, so a
+        # successful update is one statement
+        query = db.update(Website).where(Website.id == website_id)
+        if principal.role == 'client':
+            query = query.where(Website.client_id == principal.client_id)
+        if 'domain' in values and not current_app.config.get('WEBSITE_DOMAIN_INDEX'):
+            # No unique index yet, so the UPDATE checks for a conflict itself
+            other = db.aliased(Website)
+            query = query.where(~db.exists().where(
+                other.client_id == Website.client_id,
+                other.domain == values['domain'],
+                other.id != Website.id
+            ))
+        
+        website = db.session.execute(query.values(**values).returning(Website)).scalar_one_or_none()
         
-        # Update fields
-        if 'domain' in data:
-            # Check if new domain conflicts with existing websites
-            existing_website = Website.query.filter(
-                Website.client_id == website.client_id,
-                Website.domain == data['domain'],
-                Website.id != website_id
-            ).first()
+        if not website:
+            # Nothing was updated; find out why
+            current = db.session.query(Website.client_id).filter(Website.id == website_id).first()
+            if not current:
+                return jsonify({'message': 'Website not found'}), 404
             
-            if existing_website:
-                return jsonify({'message': 'Website with this domain already exists for this client'}), 409
+            if principal.role == 'client' and current.client_id != principal.client_id:
+                return jsonify({'message': 'Access denied'}), 403
             
-            website.domain = data['domain']
-        
-        if 'ga4_property_id' in data:
-            website.ga4_property_id = data['ga4_property_id']
-        
-        if 'search_console_url' in data:
-            website.search_console_url = data['search_console_url']
-        
-        if 'is_active' in data and user.role == 'admin':
-            website.is_active = data['is_active']
+            return jsonify({'message': 'Website with this domain already exists for this client'}), 409
         
-        website.updated_at = datetime.utcnow()
+        # Serialize before commit so the response doesn't reload the rows
+        website_dict = website.to_dict()
+        if is_admin:
+            client = db.session.get(Client, website.client_id, options=[lazyload(Client.user), lazyload(Client.websites)])
+            website_dict['client'] = client.to_dict()
         
         db.session.commit()
         
-        website_dict = website.to_dict()
-        if user.role == 'admin':
-            website_dict['client'] = website.client.to_dict()
-        
         return jsonify({
             'message': 'Website updated successfully',
             'website': website_dict
         }), 200
         
+    except IntegrityError:
+        # The client already has another website with this domain
+        db.session.rollback()
+        return jsonify({'message': 'Website with this domain already exists for this client'}), 409
+        
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Failed to update website: {str(e)}'}), 500
 
 @websites_bp.route('/websites/<int:website_id>', methods=['DELETE'])
 @jwt_required()
-def delete_website(website_id):
+@with_principal
+def delete_website(website_id, principal):
     """Delete a website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website = Website.query.get(website_id)
+        website = db.session.get(Website, website_id)
         if not website:
             return jsonify({'message': 'Website not found'}), 404
         
         # Check permissions
-        if user.role == 'client':
-            if not user.client or website.client_id != user.client.id:
+        if principal.role == 'client':
+            if website.client_id != principal.client_id:
                 return jsonify({'message': 'Access denied'}), 403
         
         # Soft delete by setting is_active to False
         website.is_active = False
-        website.updated_at = datetime.utcnow()
         
         db.session.commit()
         
@@ -234,22 +357,20 @@ def delete_website(website_id):
 
 @websites_bp.route('/websites/<int:website_id>/verify-ga4', methods=['POST'])
 @jwt_required()
-def verify_ga4_connection(website_id):
+@with_principal
+def verify_ga4_connection(website_id, principal):
     """Verify GA4 connection for a website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website = Website.query.get(website_id)
+        # Read-only, so only the columns the check and response use
+        website = db.session.query(
+            Website.client_id, Website.domain, Website.ga4_property_id
+        ).filter_by(id=website_id).one_or_none()
         if not website:
             return jsonify({'message': 'Website not found'}), 404
         
         # Check permissions
-        if user.role == 'client':
-            if not user.client or website.client_id != user.client.id:
+        if principal.role == 'client':
+            if website.client_id != principal.client_id:
                 return jsonify({'message': 'Access denied'}), 403
         
         if not website.ga4_property_id:
@@ -275,22 +396,20 @@ def verify_ga4_connection(website_id):
 
 @websites_bp.route('/websites/<int:website_id>/verify-gsc', methods=['POST'])
 @jwt_required()
-def verify_search_console_connection(website_id):
+@with_principal
+def verify_search_console_connection(website_id, principal):
     """Verify Google Search Console connection for a website."""
     try:
-        current_user_id = int(get_jwt_identity())
-        user = User.query.get(current_user_id)
-        
-        if not user:
-            return jsonify({'message': 'User not found'}), 404
-        
-        website = Website.query.get(website_id)
+        # Read-only, so only the columns the check and response use
+        website = db.session.query(
+            Website.client_id, Website.search_console_url
+        ).filter_by(id=website_id).one_or_none()
         if not website:
             return jsonify({'message': 'Website not found'}), 404
         
         # Check permissions
-        if user.role == 'client':
-            if not user.client or website.client_id != user.client.id:
+        if principal.role == 'client':
+            if website.client_id != principal.client_id:
                 return jsonify({'message': 'Access denied'}), 403
         
         if not website.search_console_url:
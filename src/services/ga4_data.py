@@ -1,122 +1,246 @@
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from datetime import datetime, timedelta
+from src.utils.executor import WorkerPool
+from datetime import date, timedelta
 import json
+from src.services.google_api import execute, google_service
+from src.utils.cache import cache, ga4_report_key
+
+# Runs the reports of a dashboard side by side
+_report_pool = WorkerPool(max_workers=4, thread_name_prefix='ga4-data')
+
+# Reports over recent days are refetched after a few minutes; GA4 can take
+# up to 48 hours to finish processing a day, so only older ranges are final
+REPORT_CACHE_TIMEOUT = 300
+HISTORICAL_REPORT_CACHE_TIMEOUT = 24 * 60 * 60
+GA4_PROCESSING_DELAY = timedelta(days=2)
+
+# The fixed part of each report request; only the property and the date
+# range change between calls. Shared by every request, so never mutated.
+ANALYTICS_REPORT = {
+    'metrics': [
+        {'name': 'activeUsers'},
+        {'name': 'sessions'},
+        {'name': 'screenPageViews'},
+        {'name': 'bounceRate'},
+        {'name': 'averageSessionDuration'}
+    ],
+    'dimensions': [
+        {'name': 'date'}
+    ]
+}
+
+REALTIME_REPORT = {
+    'metrics': [
+        {'name': 'activeUsers'}
+    ]
+}
+
+PAGES_REPORT = {
+    'metrics': [
+        {'name': 'screenPageViews'},
+        {'name': 'activeUsers'}
+    ],
+    'dimensions': [
+        {'name': 'pagePath'},
+        {'name': 'pageTitle'}
+    ],
+    'orderBys': [
+        {'metric': {'metricName': 'screenPageViews'}, 'desc': True}
+    ],
+    'limit': 10
+}
+
+TRAFFIC_SOURCES_REPORT = {
+    'metrics': [
+        {'name': 'sessions'},
+        {'name': 'activeUsers'}
+    ],
+    'dimensions': [
+        {'name': 'sessionDefaultChannelGroup'}
+    ],
+    'orderBys': [
+        {'metric': {'metricName': 'sessions'}, 'desc': True}
+    ]
+}
+
+def _report_cache_timeout(end_date):
+    """How long a report ending on end_date stays cached."""
+    try:
+        historical = date.fromisoformat(end_date) < date.today() - GA4_PROCESSING_DELAY
+    except ValueError:
+        # Relative dates such as 'today' or '7daysAgo' move with the calendar
+        historical = False
+    return HISTORICAL_REPORT_CACHE_TIMEOUT if historical else REPORT_CACHE_TIMEOUT
 
 class GA4DataService:
     def __init__(self):
         pass
 
-    def get_analytics_data(self, access_token, property_id, start_date=None, end_date=None):
-        """Fetch analytics data from GA4"""
+    def get_dashboard(self, access_token, property_id, start_date=None, end_date=None):
+        """Fetch analytics, real-time, top pages and traffic sources data concurrently"""
         credentials = Credentials(token=access_token)
+        properties = google_service('analyticsdata', 'v1beta').properties()
+        name = f'properties/{property_id}'
+        start_date, end_date = self._resolve_dates(start_date, end_date)
         
-        # Build Analytics Data API service
-        analytics = build('analyticsdata', 'v1beta', credentials=credentials)
+        dashboard, missing = self._cached_reports(property_id, start_date, end_date)
         
-        # Default date range (last 30 days)
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
+        reports = {
+            report: (properties.runReport(property=name, body=body), format_response)
+            for report, (body, format_response) in missing.items()
+        }
+        reports['realtime'] = (
+            properties.runRealtimeReport(property=name, body=self._realtime_request(property_id)),
+            self._format_realtime_response
+        )
         
-        # Basic metrics request
-        request = {
-            'property': f'properties/{property_id}',
-            'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
-            'metrics': [
-                {'name': 'activeUsers'},
-                {'name': 'sessions'},
-                {'name': 'screenPageViews'},
-                {'name': 'bounceRate'},
-                {'name': 'averageSessionDuration'}
-            ],
-            'dimensions': [
-                {'name': 'date'}
-            ]
+        futures = {
+            report: _report_pool.submit(execute, request, credentials)
+            for report, (request, _) in reports.items()
         }
         
-        response = analytics.properties().runReport(body=request).execute()
+        for report, future in futures.items():
+            dashboard[report] = reports[report][1](future.result())
         
-        return self._format_analytics_response(response)
+        self._cache_reports(property_id, start_date, end_date, {report: dashboard[report] for report in missing})
+        return dashboard
 
-    def get_real_time_data(self, access_token, property_id):
-        """Fetch real-time analytics data from GA4"""
+    def get_dashboard_batch(self, access_token, property_id, start_date=None, end_date=None):
+        """Fetch the same data as get_dashboard with the three reports in one batchRunReports call"""
         credentials = Credentials(token=access_token)
+        properties = google_service('analyticsdata', 'v1beta').properties()
+        name = f'properties/{property_id}'
+        start_date, end_date = self._resolve_dates(start_date, end_date)
         
-        # Build Analytics Data API service
-        analytics = build('analyticsdata', 'v1beta', credentials=credentials)
+        dashboard, missing = self._cached_reports(property_id, start_date, end_date)
         
-        request = {
-            'property': f'properties/{property_id}',
-            'metrics': [
-                {'name': 'activeUsers'}
-            ]
-        }
+        # Real-time reports can't be batched, so that one runs alongside
+        realtime = _report_pool.submit(
+            execute, properties.runRealtimeReport(property=name, body=self._realtime_request(property_id)), credentials
+        )
+        
+        if missing:
+            batch = execute(properties.batchRunReports(property=name, body={
+                'requests': [body for body, _ in missing.values()]
+            }), credentials)
+            
+            # Reports come back in the order they were requested
+            for (report, (_, format_response)), response in zip(missing.items(), batch['reports']):
+                dashboard[report] = format_response(response)
+            
+            self._cache_reports(property_id, start_date, end_date, {report: dashboard[report] for report in missing})
+        
+        dashboard['realtime'] = self._format_realtime_response(realtime.result())
+        return dashboard
+
+    def get_analytics_data(self, access_token, property_id, start_date=None, end_date=None):
+        """Fetch analytics data from GA4"""
+        return self._get_report('analytics', access_token, property_id, start_date, end_date)
+
+    def get_real_time_data(self, access_token, property_id):
+        """Fetch real-time analytics data from GA4"""
+        credentials = Credentials(token=access_token)
+        analytics = google_service('analyticsdata', 'v1beta')
         
-        response = analytics.properties().runRealtimeReport(body=request).execute()
+        # Unlike the date-ranged reports, real-time data isn't cached here
+        request = self._realtime_request(property_id)
+        response = execute(analytics.properties().runRealtimeReport(
+            property=request['property'], body=request
+        ), credentials)
         
         return self._format_realtime_response(response)
 
     def get_top_pages(self, access_token, property_id, start_date=None, end_date=None):
         """Get top pages data"""
-        credentials = Credentials(token=access_token)
-        analytics = build('analyticsdata', 'v1beta', credentials=credentials)
+        return self._get_report('pages', access_token, property_id, start_date, end_date)
+
+    def get_traffic_sources(self, access_token, property_id, start_date=None, end_date=None):
+        """Get traffic sources data"""
+        return self._get_report('traffic_sources', access_token, property_id, start_date, end_date)
+
+    def _get_report(self, report, access_token, property_id, start_date, end_date):
+        """Serve one date-range report from the cache, running it on GA4 on a miss"""
+        start_date, end_date = self._resolve_dates(start_date, end_date)
+        key = ga4_report_key(property_id, report, start_date, end_date)
+        
+        data = cache.get(key)
+        if data is None:
+            request, format_response = self._report_specs(property_id, start_date, end_date)[report]
+            response = execute(google_service('analyticsdata', 'v1beta').properties().runReport(
+                property=request['property'], body=request
+            ), Credentials(token=access_token))
+            
+            data = format_response(response)
+            cache.set(key, data, timeout=_report_cache_timeout(end_date))
         
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
+        return data
+
+    def _cached_reports(self, property_id, start_date, end_date):
+        """Split the date-range reports into cached data and the specs of the ones to fetch"""
+        specs = self._report_specs(property_id, start_date, end_date)
+        cached = cache.get_many(*(ga4_report_key(property_id, report, start_date, end_date) for report in specs))
         
-        request = {
+        found, missing = {}, {}
+        for (report, spec), data in zip(specs.items(), cached):
+            if data is None:
+                missing[report] = spec
+            else:
+                found[report] = data
+        return found, missing
+
+    def _cache_reports(self, property_id, start_date, end_date, reports):
+        """Cache freshly fetched date-range reports"""
+        if reports:
+            cache.set_many({
+                ga4_report_key(property_id, report, start_date, end_date): data
+                for report, data in reports.items()
+            }, timeout=_report_cache_timeout(end_date))
+
+    def _resolve_dates(self, start_date, end_date):
+        """Fill in the default date range (last 30 days)"""
+        # Called once per fetch; every report of a dashboard shares the result
+        today = date.today()
+        return (
+            start_date or (today - timedelta(days=30)).isoformat(),
+            end_date or today.isoformat()
+        )
+
+    def _report_specs(self, property_id, start_date, end_date):
+        """Request body and response formatter of each cacheable report"""
+        return {
+            'analytics': (self._analytics_request(property_id, start_date, end_date), self._format_analytics_response),
+            'pages': (self._pages_request(property_id, start_date, end_date), self._format_pages_response),
+            'traffic_sources': (self._traffic_sources_request(property_id, start_date, end_date),
+                                self._format_traffic_sources_response)
+        }
+
+    def _analytics_request(self, property_id, start_date, end_date):
+        """Basic metrics request"""
+        return {
             'property': f'properties/{property_id}',
             'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
-            'metrics': [
-                {'name': 'screenPageViews'},
-                {'name': 'activeUsers'}
-            ],
-            'dimensions': [
-                {'name': 'pagePath'},
-                {'name': 'pageTitle'}
-            ],
-            'orderBys': [
-                {'metric': {'metricName': 'screenPageViews'}, 'desc': True}
-            ],
-            'limit': 10
+            **ANALYTICS_REPORT
         }
-        
-        response = analytics.properties().runReport(body=request).execute()
-        
-        return self._format_pages_response(response)
 
-    def get_traffic_sources(self, access_token, property_id, start_date=None, end_date=None):
-        """Get traffic sources data"""
-        credentials = Credentials(token=access_token)
-        analytics = build('analyticsdata', 'v1beta', credentials=credentials)
-        
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
-        
-        request = {
+    def _realtime_request(self, property_id):
+        """Real-time active users request"""
+        return {'property': f'properties/{property_id}', **REALTIME_REPORT}
+
+    def _pages_request(self, property_id, start_date, end_date):
+        """Top pages request"""
+        return {
             'property': f'properties/{property_id}',
             'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
-            'metrics': [
-                {'name': 'sessions'},
-                {'name': 'activeUsers'}
-            ],
-            'dimensions': [
-                {'name': 'sessionDefaultChannelGroup'}
-            ],
-            'orderBys': [
-                {'metric': {'metricName': 'sessions'}, 'desc': True}
-            ]
+            **PAGES_REPORT
+        }
+
+    def _traffic_sources_request(self, property_id, start_date, end_date):
+        """Traffic sources request"""
+        return {
+            'property': f'properties/{property_id}',
+            'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
+            **TRAFFIC_SOURCES_REPORT
         }
-        
-        response = analytics.properties().runReport(body=request).execute()
-        
-        return self._format_traffic_sources_response(response)
 
     def _format_analytics_response(self, response):
         """Format the analytics API response"""
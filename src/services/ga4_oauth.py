@@ -4,8 +4,8 @@ from datetime import datetime, timedelta
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 from flask import current_app
+from src.services.google_api import authorized_http, google_service
 
 class GA4OAuthService:
     def __init__(self):
@@ -57,8 +57,8 @@ class GA4OAuthService:
         credentials = flow.credentials
         
         # Get user info
-        user_info_service = build('oauth2', 'v2', credentials=credentials)
-        user_info = user_info_service.userinfo().get().execute()
+        user_info_service = google_service('oauth2', 'v2')
+        user_info = user_info_service.userinfo().get().execute(http=authorized_http(credentials))
         
         return {
             'access_token': credentials.token,
@@ -88,20 +88,21 @@ class GA4OAuthService:
         """Get GA4 properties for the authenticated user"""
         credentials = Credentials(token=access_token)
         
-        # Build Analytics Admin API service
-        admin_service = build('analyticsadmin', 'v1beta', credentials=credentials)
+        # Analytics Admin API service; one connection serves the calls below
+        admin_service = google_service('analyticsadmin', 'v1beta')
+        http = authorized_http(credentials)
         
         # List all accounts
-        accounts_response = admin_service.accounts().list().execute()
+        accounts_response = admin_service.accounts().list().execute(http=http)
         
         properties = []
         for account in accounts_response.get('accounts', []):
             account_name = account['name']
             
             # List properties for this account
-            properties_response = admin_service.accounts().properties().list(
-                parent=account_name
-            ).execute()
+            properties_response = admin_service.properties().list(
+                filter=f'parent:{account_name}'
+            ).execute(http=http)
             
             for property_data in properties_response.get('properties', []):
                 properties.append({
@@ -1,25 +1,239 @@
 import os
+import copy
 import json
+import random
+import hashlib
+import importlib.util
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from datetime import datetime, timedelta, date
-from typing import Dict, List, Optional, Any
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import (
-    DateRange,
-    Dimension,
-    Metric,
-    RunReportRequest,
-    RunRealtimeReportRequest
-)
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Any
+import google.auth
 from google.auth.exceptions import DefaultCredentialsError
-from src.models.user import db, GA4DataCache
+import orjson
+from flask import current_app
+from src.models.user import db, GA4DataCache, GA4ResponseCache
+from src.utils.cache import cache, ga4_payload_key, ga4_generation_key
+from src.utils.executor import WorkerPool
+
+# google.analytics.data_v1beta adds a noticeable share of worker startup, so
+# it is imported where it is used, which only happens once credentials are found
+if TYPE_CHECKING:
+    from google.analytics.data_v1beta import BetaAnalyticsDataClient
+    from google.analytics.data_v1beta.types import RunReportRequest
+
+logger = logging.getLogger(__name__)
+
+# Writes cache rows off the request path (see GA4Service.cache_data_async)
+_cache_write_pool = WorkerPool(max_workers=2, thread_name_prefix='ga4-cache')
+
+
+# Expired cache rows are purged by a cache write at most this often, per process
+CACHE_PURGE_INTERVAL = 600
+
+_last_purge = float('-inf')
+_purge_lock = threading.Lock()
+
+
+def _response_cache_key(website_id, metric_name, start_date, end_date) -> str:
+    """GA4ResponseCache key for a payload fetched with these parameters."""
+    return hashlib.sha1(f'{website_id}:{metric_name}:{start_date}:{end_date}'.encode()).hexdigest()
+
+# Seconds a GA4 response is reused in this process, by report
+RESPONSE_TTLS = {
+    'overview': 300,
+    'traffic_sources': 600,
+    'page_performance': 600,
+    'realtime': 30
+}
+MAX_CACHED_RESPONSES = 1024
+
+# (report, property_id, start_date, end_date) -> (expires_at, formatted response)
+_responses = OrderedDict()
+_responses_lock = threading.Lock()
+
+# GA4 calls in progress, by cache key; threads that miss the cache for a key
+# already being fetched wait for that call instead of making their own
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _single_flight(key, fetch):
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        return future.result()
+    
+    try:
+        result = fetch()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+# Data API clients shared by the process: building one sets up auth and a
+# gRPC channel. Each client holds its own connection, and calls are spread
+# over them so concurrent dashboard reports don't queue on a single one.
+GA4_CHANNEL_POOL_SIZE = int(os.getenv('GA4_CHANNEL_POOL_SIZE', '4'))
+
+_clients = []
+_clients_lock = threading.Lock()
+_next_client_index = itertools.count()
+
+
+def _reset_clients():
+    # gRPC channels aren't fork-safe; a forked worker builds its own pool
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+def _client_pool() -> List['BetaAnalyticsDataClient']:
+    if not _clients:
+        with _clients_lock:
+            if not _clients:
+                from google.analytics.data_v1beta import BetaAnalyticsDataClient
+                
+                transport_class = BetaAnalyticsDataClient.get_transport_class('grpc')
+                
+                def create_channel(*args, options=(), **kwargs):
+                    # Channels with identical arguments otherwise share
+                    # subchannels, hence the same TCP connection
+                    return transport_class.create_channel(
+                        *args, options=[*options, ('grpc.use_local_subchannel_pool', 1)], **kwargs
+                    )
+                
+                # One credentials object, so its access token is refreshed once for all channels
+                credentials, _ = google.auth.default(scopes=transport_class.AUTH_SCOPES)
+                # Published whole, so other threads never see a partial pool
+                _clients[:] = [
+                    BetaAnalyticsDataClient(
+                        transport=transport_class(credentials=credentials, channel=create_channel)
+                    )
+                    for _ in range(max(GA4_CHANNEL_POOL_SIZE, 1))
+                ]
+    return _clients
+
+
+def _next_client() -> 'BetaAnalyticsDataClient':
+    clients = _client_pool()
+    return clients[next(_next_client_index) % len(clients)]
+
+
+OVERVIEW_METRICS = ['activeUsers', 'sessions', 'screenPageViews', 'bounceRate', 'averageSessionDuration']
+
+
+@lru_cache(maxsize=None)
+def _report_templates() -> Dict[str, 'RunReportRequest']:
+    """Everything but the property and dates of each date-ranged report, built once."""
+    from google.analytics.data_v1beta.types import Dimension, Metric, RunReportRequest
+    
+    return {
+        'overview': RunReportRequest(
+            metrics=[Metric(name=metric) for metric in OVERVIEW_METRICS]
+        ),
+        'traffic_sources': RunReportRequest(
+            dimensions=[Dimension(name='sessionDefaultChannelGrouping')],
+            metrics=[Metric(name='sessions'), Metric(name='activeUsers')],
+            limit=10
+        ),
+        'page_performance': RunReportRequest(
+            dimensions=[Dimension(name='pagePath')],
+            metrics=[
+                Metric(name=metric)
+                for metric in ['screenPageViews', 'sessions', 'userEngagementDuration', 'bounceRate']
+            ],
+            limit=20,
+            # Ordered by a metric in the request; 'pageviews' isn't a GA4 metric
+            order_bys=[{'metric': {'metric_name': 'screenPageViews'}, 'desc': True}]
+        )
+    }
+
+
+def _report_request(report, property_id, start_date, end_date) -> 'RunReportRequest':
+    from google.analytics.data_v1beta.types import DateRange, RunReportRequest
+    
+    # Copying the template's message is cheaper than building its fields again
+    request = RunReportRequest(_report_templates()[report], property=f"properties/{property_id}")
+    request.date_ranges.append(DateRange(start_date=start_date, end_date=end_date))
+    return request
+
+
+def _parse_metric(parse, value):
+    try:
+        return parse(value)
+    except ValueError:
+        # Keep anything GA4 sends that isn't a plain number as it came
+        return value
+
+
+# Dimension values used by the mock reports
+MOCK_COUNTRIES = ('United States', 'Canada', 'United Kingdom', 'Germany', 'France')
+MOCK_TRAFFIC_SOURCES = ('Organic Search', 'Direct', 'Social', 'Referral', 'Email')
+MOCK_PAGES = ('/', '/about', '/services', '/contact', '/blog', '/products', '/pricing')
+
+# Bounds of the random mock value for each metric, per dimension row and for
+# a single total row; float bounds give a rate rounded to four places
+MOCK_ROW_RANGES = {
+    'activeUsers': (100, 5000),
+    'sessions': (150, 6000),
+    'screenPageViews': (200, 8000),
+    'bounceRate': (0.3, 0.8),
+    'averageSessionDuration': (120, 300),
+    'userEngagementDuration': (60, 200)
+}
+MOCK_TOTAL_RANGES = {
+    'activeUsers': (1000, 10000),
+    'sessions': (1500, 12000),
+    'screenPageViews': (2000, 15000),
+    'bounceRate': (0.4, 0.7),
+    'averageSessionDuration': (120, 300),
+    'userEngagementDuration': (80, 250)
+}
+
+
+def _mock_value(ranges, metric, default):
+    low, high = ranges.get(metric, default)
+    if isinstance(low, float):
+        return round(random.uniform(low, high), 4)
+    return random.randint(low, high)
+
+
+# Date-ranged reports by the name they are cached under (see _report_templates)
+REPORTS = ('overview', 'traffic_sources', 'page_performance')
+
 
 class GA4Service:
-    """Service for interacting with Google Analytics 4 Data API."""
+    """Service for interacting with Google Analytics 4 Data API.
+    
+    Import the ``ga4_service`` instance below rather than creating another.
+    """
     
     def __init__(self):
-        self.client = None
         self.credentials_available = False
+        self._pending_writes = set()
+        self._pending_lock = threading.Lock()
         self._initialize_client()
+        # Mock payloads are built once at startup; without credentials every
+        # request is served a copy of them instead of regenerating the same shape
+        self._mock_reports = {report: self._build_mock_report(report) for report in REPORTS}
+        self._mock_realtime = self._get_mock_realtime_data()
     
     def _initialize_client(self):
         """Initialize the GA4 client with credentials."""
@@ -27,20 +241,34 @@ class GA4Service:
             # Check if credentials are available
             credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
             if credentials_path and os.path.exists(credentials_path):
-                self.client = BetaAnalyticsDataClient()
+                # Only check the library is there. The service is created at
+                # import, in the gunicorn master with preload_app, and gRPC
+                # channels don't survive a fork, so the pool is built on first
+                # use in the worker.
+                if importlib.util.find_spec('google.analytics.data_v1beta') is None:
+                    raise ImportError('google-analytics-data is not installed')
                 self.credentials_available = True
-                print("GA4 client initialized successfully")
+                logger.info("GA4 client initialized successfully")
             else:
-                print("GA4 credentials not found, using mock data")
+                logger.warning("GA4 credentials not found, using mock data")
                 self.credentials_available = False
-        except Exception as e:
-            print(f"Failed to initialize GA4 client: {str(e)}")
+        except ImportError:
+            logger.warning("Google Analytics library not available, using mock data")
+            self.credentials_available = False
+        except Exception:
+            logger.exception("Failed to initialize GA4 client")
             self.credentials_available = False
     
+    @property
+    def client(self) -> Optional['BetaAnalyticsDataClient']:
+        """The next client from the shared pool, or None without credentials.
+
+        Each access moves the round-robin on, so read it once per call.
+        """
+        return _next_client() if self.credentials_available else None
+    
     def _get_mock_data(self, metric_names: List[str], dimension_names: List[str] = None) -> Dict[str, Any]:
         """Generate mock data for testing when real credentials aren't available."""
-        import random
-        
         mock_data = {
             'dimension_headers': [],
             'metric_headers': [],
@@ -61,51 +289,22 @@ class GA4Service:
         
         # Generate mock rows
         if dimension_names and 'country' in dimension_names:
-            countries = ['United States', 'Canada', 'United Kingdom', 'Germany', 'France']
-            for country in countries:
+            for country in MOCK_COUNTRIES:
                 row = {
                     'dimension_values': [{'value': country}],
                     'metric_values': []
                 }
                 for metric in metric_names:
-                    if metric == 'activeUsers':
-                        value = random.randint(100, 5000)
-                    elif metric == 'sessions':
-                        value = random.randint(150, 6000)
-                    elif metric == 'screenPageViews':
-                        value = random.randint(200, 8000)
-                    elif metric == 'bounceRate':
-                        value = round(random.uniform(0.3, 0.8), 4)
-                    elif metric == 'averageSessionDuration':
-                        value = random.randint(120, 300)
-                    elif metric == 'userEngagementDuration':
-                        value = random.randint(60, 200)
-                    else:
-                        value = random.randint(50, 1000)
-                    
-                    row['metric_values'].append({'value': str(value)})
+                    value = _mock_value(MOCK_ROW_RANGES, metric, (50, 1000))
+                    row['metric_values'].append({'value': value})
                 
                 mock_data['rows'].append(row)
         else:
             # Single row for overview metrics
             row = {'metric_values': []}
             for metric in metric_names:
-                if metric == 'activeUsers':
-                    value = random.randint(1000, 10000)
-                elif metric == 'sessions':
-                    value = random.randint(1500, 12000)
-                elif metric == 'screenPageViews':
-                    value = random.randint(2000, 15000)
-                elif metric == 'bounceRate':
-                    value = round(random.uniform(0.4, 0.7), 4)
-                elif metric == 'averageSessionDuration':
-                    value = random.randint(120, 300)
-                elif metric == 'userEngagementDuration':
-                    value = random.randint(80, 250)
-                else:
-                    value = random.randint(100, 5000)
-                
-                row['metric_values'].append({'value': str(value)})
+                value = _mock_value(MOCK_TOTAL_RANGES, metric, (100, 5000))
+                row['metric_values'].append({'value': value})
             
             mock_data['rows'].append(row)
         
@@ -113,72 +312,114 @@ class GA4Service:
     
     def get_overview_metrics(self, property_id: str, start_date: str = None, end_date: str = None) -> Dict[str, Any]:
         """Get overview metrics for a GA4 property."""
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
-        
-        metrics = [
-            'activeUsers',
-            'sessions', 
-            'screenPageViews',  # Changed from 'pageviews' to GA4 standard
-            'bounceRate',
-            'averageSessionDuration'
-        ]
-        
-        if self.credentials_available and self.client:
-            try:
-                request = RunReportRequest(
-                    property=f"properties/{property_id}",
-                    date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
-                    metrics=[Metric(name=metric) for metric in metrics]
-                )
-                
-                response = self.client.run_report(request)
-                return self._format_response(response)
-                
-            except Exception as e:
-                print(f"Error fetching GA4 data: {str(e)}")
-                return self._get_mock_data(metrics)
-        else:
-            return self._get_mock_data(metrics)
+        return self._get_report('overview', property_id, start_date, end_date)
     
     def get_traffic_sources(self, property_id: str, start_date: str = None, end_date: str = None) -> Dict[str, Any]:
         """Get traffic sources data."""
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
+        return self._get_report('traffic_sources', property_id, start_date, end_date)
+    
+    def get_page_performance(self, property_id: str, start_date: str = None, end_date: str = None) -> Dict[str, Any]:
+        """Get page performance data."""
+        return self._get_report('page_performance', property_id, start_date, end_date)
+    
+    def get_dashboard_bundle(self, property_id: str, start_date: str = None, end_date: str = None,
+                             reports: List[str] = None) -> Dict[str, Dict[str, Any]]:
+        """Get several date-ranged reports, keyed by report name, in one batchRunReports call."""
+        return self._get_reports(list(reports or REPORTS), property_id, start_date, end_date)
+    
+    def _get_report(self, report: str, property_id: str, start_date: str, end_date: str) -> Dict[str, Any]:
+        if not self.credentials_available:
+            return self._get_mock_report(report)
         
-        metrics = ['sessions', 'activeUsers']
-        dimensions = ['sessionDefaultChannelGrouping']
+        start_date, end_date = self._resolve_dates(start_date, end_date)
+        key = (report, property_id, start_date, end_date)
+        cached = self._cached_response(key)
+        if cached is not None:
+            return cached
         
-        if self.credentials_available and self.client:
-            try:
-                request = RunReportRequest(
-                    property=f"properties/{property_id}",
-                    date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
-                    dimensions=[Dimension(name=dim) for dim in dimensions],
-                    metrics=[Metric(name=metric) for metric in metrics],
-                    limit=10
+        return _single_flight(key, lambda: self._fetch_report(report, property_id, start_date, end_date))
+    
+    def _fetch_report(self, report: str, property_id: str, start_date: str, end_date: str) -> Dict[str, Any]:
+        try:
+            client = self.client
+            request = _report_request(report, property_id, start_date, end_date)
+            response = client.run_report(request)
+            return self._store_response((report, property_id, start_date, end_date), self._format_response(response))
+            
+        except Exception:
+            logger.exception("Error fetching GA4 %s report", report)
+            return self._get_mock_report(report)
+    
+    def _get_reports(self, reports: List[str], property_id: str,
+                     start_date: str, end_date: str) -> Dict[str, Dict[str, Any]]:
+        if not self.credentials_available:
+            return {report: self._get_mock_report(report) for report in reports}
+        
+        start_date, end_date = self._resolve_dates(start_date, end_date)
+        results = {}
+        missing = []
+        for report in reports:
+            cached = self._cached_response((report, property_id, start_date, end_date))
+            if cached is not None:
+                results[report] = cached
+            else:
+                missing.append(report)
+        
+        if missing:
+            results.update(_single_flight(
+                ('batch', property_id, start_date, end_date, tuple(missing)),
+                lambda: self._fetch_reports(missing, property_id, start_date, end_date)
+            ))
+        return results
+    
+    def _fetch_reports(self, missing: List[str], property_id: str,
+                       start_date: str, end_date: str) -> Dict[str, Dict[str, Any]]:
+        results = {}
+        try:
+            from google.analytics.data_v1beta.types import BatchRunReportsRequest
+            
+            client = self.client
+            # Up to five reports per batch; the dashboard needs three
+            response = client.batch_run_reports(BatchRunReportsRequest(
+                property=f"properties/{property_id}",
+                requests=[_report_request(report, property_id, start_date, end_date) for report in missing]
+            ))
+            # Reports come back in request order
+            for report, report_response in zip(missing, response.reports):
+                results[report] = self._store_response(
+                    (report, property_id, start_date, end_date), self._format_response(report_response)
                 )
                 
-                response = self.client.run_report(request)
-                return self._format_response(response)
-                
-            except Exception as e:
-                print(f"Error fetching traffic sources: {str(e)}")
-                # Mock traffic sources
-                mock_sources = ['Organic Search', 'Direct', 'Social', 'Referral', 'Email']
-                return self._get_mock_traffic_sources(mock_sources)
-        else:
-            mock_sources = ['Organic Search', 'Direct', 'Social', 'Referral', 'Email']
-            return self._get_mock_traffic_sources(mock_sources)
+        except Exception:
+            logger.exception("Error fetching GA4 dashboard reports")
+            for report in missing:
+                results[report] = self._get_mock_report(report)
+        
+        return results
+    
+    def _resolve_dates(self, start_date: Optional[str], end_date: Optional[str]):
+        if start_date and end_date:
+            return start_date, end_date
+        # One clock read, so both defaults agree on the day
+        today = date.today()
+        return start_date or (today - timedelta(days=30)).isoformat(), end_date or today.isoformat()
+    
+    def _get_mock_report(self, report: str) -> Dict[str, Any]:
+        # A copy, so a caller that edits its result can't change the shared payload
+        return copy.deepcopy(self._mock_reports[report])
+    
+    def _get_mock_realtime(self) -> Dict[str, Any]:
+        return copy.deepcopy(self._mock_realtime)
     
-    def _get_mock_traffic_sources(self, sources: List[str]) -> Dict[str, Any]:
+    def _build_mock_report(self, report: str) -> Dict[str, Any]:
+        if report == 'traffic_sources':
+            return self._get_mock_traffic_sources(MOCK_TRAFFIC_SOURCES)
+        if report == 'page_performance':
+            return self._get_mock_page_data()
+        return self._get_mock_data(OVERVIEW_METRICS)
+    
+    def _get_mock_traffic_sources(self, sources: Sequence[str]) -> Dict[str, Any]:
         """Generate mock traffic sources data."""
-        import random
-        
         mock_data = {
             'dimension_headers': [{'name': 'sessionDefaultChannelGrouping'}],
             'metric_headers': [
@@ -195,50 +436,16 @@ class GA4Service:
             row = {
                 'dimension_values': [{'value': source}],
                 'metric_values': [
-                    {'value': str(sessions)},
-                    {'value': str(users)}
+                    {'value': sessions},
+                    {'value': users}
                 ]
             }
             mock_data['rows'].append(row)
         
         return mock_data
     
-    def get_page_performance(self, property_id: str, start_date: str = None, end_date: str = None) -> Dict[str, Any]:
-        """Get page performance data."""
-        if not start_date:
-            start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        if not end_date:
-            end_date = datetime.now().strftime('%Y-%m-%d')
-        
-        metrics = ['screenPageViews', 'sessions', 'userEngagementDuration', 'bounceRate']
-        dimensions = ['pagePath']
-        
-        if self.credentials_available and self.client:
-            try:
-                request = RunReportRequest(
-                    property=f"properties/{property_id}",
-                    date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
-                    dimensions=[Dimension(name=dim) for dim in dimensions],
-                    metrics=[Metric(name=metric) for metric in metrics],
-                    limit=20,
-                    order_bys=[{'metric': {'metric_name': 'pageviews'}, 'desc': True}]
-                )
-                
-                response = self.client.run_report(request)
-                return self._format_response(response)
-                
-            except Exception as e:
-                print(f"Error fetching page performance: {str(e)}")
-                return self._get_mock_page_data()
-        else:
-            return self._get_mock_page_data()
-    
     def _get_mock_page_data(self) -> Dict[str, Any]:
         """Generate mock page performance data."""
-        import random
-        
-        pages = ['/', '/about', '/services', '/contact', '/blog', '/products', '/pricing']
-        
         mock_data = {
             'dimension_headers': [{'name': 'pagePath'}],
             'metric_headers': [
@@ -250,7 +457,7 @@ class GA4Service:
             'rows': []
         }
         
-        for page in pages:
+        for page in MOCK_PAGES:
             pageviews = random.randint(50, 1000)
             sessions = random.randint(40, int(pageviews * 0.8))
             engagement_duration = random.randint(30, 300)
@@ -259,10 +466,10 @@ class GA4Service:
             row = {
                 'dimension_values': [{'value': page}],
                 'metric_values': [
-                    {'value': str(pageviews)},
-                    {'value': str(sessions)},
-                    {'value': str(engagement_duration)},
-                    {'value': str(bounce_rate)}
+                    {'value': pageviews},
+                    {'value': sessions},
+                    {'value': engagement_duration},
+                    {'value': bounce_rate}
                 ]
             }
             mock_data['rows'].append(row)
@@ -273,178 +480,265 @@ class GA4Service:
         """Get real-time data."""
         metrics = ['activeUsers']
         
-        if self.credentials_available and self.client:
-            try:
-                request = RunRealtimeReportRequest(
-                    property=f"properties/{property_id}",
-                    metrics=[Metric(name=metric) for metric in metrics]
-                )
-                
-                response = self.client.run_realtime_report(request)
-                return self._format_response(response)
-                
-            except Exception as e:
-                print(f"Error fetching realtime data: {str(e)}")
-                return self._get_mock_realtime_data()
+        if self.credentials_available:
+            key = ('realtime', property_id, None, None)
+            cached = self._cached_response(key)
+            if cached is not None:
+                return cached
+            return _single_flight(key, lambda: self._fetch_realtime(key, property_id, metrics))
         else:
-            return self._get_mock_realtime_data()
+            return self._get_mock_realtime()
+    
+    def _fetch_realtime(self, key, property_id: str, metrics: List[str]) -> Dict[str, Any]:
+        try:
+            from google.analytics.data_v1beta.types import Metric, RunRealtimeReportRequest
+            
+            request = RunRealtimeReportRequest(
+                property=f"properties/{property_id}",
+                metrics=[Metric(name=metric) for metric in metrics]
+            )
+            
+            client = self.client
+            response = client.run_realtime_report(request)
+            return self._store_response(key, self._format_response(response))
+            
+        except Exception:
+            logger.exception("Error fetching realtime data")
+            return self._get_mock_realtime()
     
     def _get_mock_realtime_data(self) -> Dict[str, Any]:
         """Generate mock real-time data."""
-        import random
-        
         return {
             'metric_headers': [{'name': 'activeUsers', 'type': 'TYPE_INTEGER'}],
             'rows': [{
-                'metric_values': [{'value': str(random.randint(5, 50))}]
+                'metric_values': [{'value': random.randint(5, 50)}]
             }]
         }
     
+    def _cached_response(self, key) -> Optional[Dict[str, Any]]:
+        """Return a response fetched within its report's TTL, or None."""
+        with _responses_lock:
+            entry = _responses.get(key)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at <= time.monotonic():
+                del _responses[key]
+                return None
+            _responses.move_to_end(key)
+            return data
+    
+    def _store_response(self, key, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Keep a formatted response for its report's TTL and return it."""
+        # Mock data from a failed call never gets here, so it isn't reused
+        with _responses_lock:
+            _responses[key] = (time.monotonic() + RESPONSE_TTLS[key[0]], data)
+            _responses.move_to_end(key)
+            while len(_responses) > MAX_CACHED_RESPONSES:
+                _responses.popitem(last=False)
+        return data
+    
+    def invalidate(self, property_id: str):
+        """Drop every response cached in this process for a GA4 property."""
+        with _responses_lock:
+            for key in [k for k in _responses if k[1] == property_id]:
+                del _responses[key]
+    
     def _format_response(self, response) -> Dict[str, Any]:
         """Format GA4 API response to a consistent structure."""
-        formatted_response = {
-            'dimension_headers': [],
-            'metric_headers': [],
-            'rows': []
-        }
-        
-        # Add dimension headers
-        if hasattr(response, 'dimension_headers'):
-            for header in response.dimension_headers:
-                formatted_response['dimension_headers'].append({'name': header.name})
-        
-        # Add metric headers
-        if hasattr(response, 'metric_headers'):
-            for header in response.metric_headers:
-                formatted_response['metric_headers'].append({
-                    'name': header.name,
-                    'type': header.type_.name if hasattr(header, 'type_') else 'TYPE_STRING'
-                })
+        # Metric values arrive as strings; parse them once here so cached and
+        # served payloads carry numbers
+        parsers = [
+            int if header.type_.name == 'TYPE_INTEGER' else float for header in response.metric_headers
+        ]
         
-        # Add rows
-        if hasattr(response, 'rows'):
-            for row in response.rows:
-                formatted_row = {
-                    'dimension_values': [],
-                    'metric_values': []
+        # Report and realtime responses always carry these fields, empty
+        # when GA4 has nothing to return, so they're read without guards
+        return {
+            'dimension_headers': [{'name': header.name} for header in response.dimension_headers],
+            'metric_headers': [
+                {'name': header.name, 'type': header.type_.name} for header in response.metric_headers
+            ],
+            # Clients read the {'value': ...} wrappers, so the shape stays
+            'rows': [
+                {
+                    'dimension_values': [{'value': dim_value.value} for dim_value in row.dimension_values],
+                    'metric_values': [
+                        {'value': _parse_metric(parse, metric_value.value)}
+                        for parse, metric_value in zip(parsers, row.metric_values)
+                    ]
                 }
-                
-                # Add dimension values
-                if hasattr(row, 'dimension_values'):
-                    for dim_value in row.dimension_values:
-                        formatted_row['dimension_values'].append({'value': dim_value.value})
-                
-                # Add metric values
-                if hasattr(row, 'metric_values'):
-                    for metric_value in row.metric_values:
-                        formatted_row['metric_values'].append({'value': metric_value.value})
-                
-                formatted_response['rows'].append(formatted_row)
-        
-        return formatted_response
+                for row in response.rows
+            ]
+        }
     
     def cache_data(self, website_id: int, metric_name: str, data: Dict[str, Any], 
                    start_date: str, end_date: str, cache_hours: int = 4):
         """Cache GA4 data in the database."""
         try:
-            # Clear existing cache for this metric and date range
-            GA4DataCache.query.filter(
-                GA4DataCache.website_id == website_id,
-                GA4DataCache.metric_name == metric_name,
-                GA4DataCache.date_range_start == datetime.strptime(start_date, '%Y-%m-%d').date(),
-                GA4DataCache.date_range_end == datetime.strptime(end_date, '%Y-%m-%d').date()
-            ).delete()
+            # The whole payload in one row, replacing any earlier one for these parameters
+            db.session.merge(GA4ResponseCache(
+                key=_response_cache_key(website_id, metric_name, start_date, end_date),
+                website_id=website_id,
+                response_json=orjson.dumps(data).decode(),
+                expires_at=datetime.utcnow() + timedelta(hours=cache_hours)
+            ))
             
-            # Cache new data
-            expires_at = datetime.utcnow() + timedelta(hours=cache_hours)
+            db.session.commit()
+            logger.debug("Cached GA4 data for website %s, metric %s", website_id, metric_name)
             
-            for row in data.get('rows', []):
-                for i, metric_value in enumerate(row.get('metric_values', [])):
-                    # Get dimension value if available
-                    dimension_value = None
-                    dimension_name = None
-                    
-                    if row.get('dimension_values') and data.get('dimension_headers'):
-                        dimension_value = row['dimension_values'][0]['value']
-                        dimension_name = data['dimension_headers'][0]['name']
-                    
-                    cache_entry = GA4DataCache(
-                        website_id=website_id,
-                        metric_name=metric_name,
-                        dimension_name=dimension_name,
-                        dimension_value=dimension_value,
-                        metric_value=float(metric_value['value']),
-                        date_range_start=datetime.strptime(start_date, '%Y-%m-%d').date(),
-                        date_range_end=datetime.strptime(end_date, '%Y-%m-%d').date(),
-                        expires_at=expires_at
-                    )
-                    
-                    db.session.add(cache_entry)
+            self._purge_expired()
             
-            db.session.commit()
-            print(f"Cached GA4 data for website {website_id}, metric {metric_name}")
+            # Keep the payload in the shared cache as well for the same lifetime
+            self._store_payloads(website_id, {metric_name: data}, start_date, end_date, cache_hours * 3600)
             
-        except Exception as e:
+        except Exception:
             db.session.rollback()
-            print(f"Failed to cache GA4 data: {str(e)}")
+            logger.exception("Failed to cache GA4 data")
+    
+    def _purge_expired(self):
+        """Delete expired cache rows, unless another write did so recently."""
+        global _last_purge
+        now = time.monotonic()
+        with _purge_lock:
+            if now - _last_purge < CACHE_PURGE_INTERVAL:
+                return
+            _last_purge = now
+        
+        try:
+            # Rows from the older per-value cache table only ever expire, so go too
+            cutoff = datetime.utcnow()
+            for model in (GA4ResponseCache, GA4DataCache):
+                db.session.execute(
+                    db.delete(model).where(model.expires_at < cutoff),
+                    execution_options={'synchronize_session': False}
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Failed to purge expired GA4 cache rows")
+    
+    def cache_data_async(self, website_id: int, metric_name: str, data: Dict[str, Any],
+                         start_date: str, end_date: str, cache_hours: int = 4):
+        """Queue cache_data on a background thread so the response doesn't wait on the writes."""
+        key = (website_id, metric_name, start_date, end_date)
+        with self._pending_lock:
+            # cache_data replaces the rows for this key; a second concurrent
+            # write would race it into duplicates, and the first one is current
+            if key in self._pending_writes:
+                return
+            self._pending_writes.add(key)
+        
+        app = current_app._get_current_object()
+        
+        def write():
+            try:
+                # Runs in its own app context, hence its own DB session
+                with app.app_context():
+                    self.cache_data(website_id, metric_name, data, start_date, end_date, cache_hours)
+            finally:
+                with self._pending_lock:
+                    self._pending_writes.discard(key)
+        
+        _cache_write_pool.submit(write)
     
     def get_cached_data(self, website_id: int, metric_name: str, 
                        start_date: str, end_date: str) -> Optional[Dict[str, Any]]:
         """Retrieve cached GA4 data."""
+        return self.get_cached_data_many(website_id, [metric_name], start_date, end_date).get(metric_name)
+    
+    def get_cached_data_many(self, website_id: int, metric_names: List[str],
+                             start_date: str, end_date: str) -> Dict[str, Dict[str, Any]]:
+        """Retrieve cached GA4 data for several metrics, keyed by metric name.
+        
+        Payloads are read from the shared cache in one round trip; only the
+        metrics missing there are looked up in the database, in one query.
+        """
         try:
-            cached_entries = GA4DataCache.query.filter(
-                GA4DataCache.website_id == website_id,
-                GA4DataCache.metric_name == metric_name,
-                GA4DataCache.date_range_start == datetime.strptime(start_date, '%Y-%m-%d').date(),
-                GA4DataCache.date_range_end == datetime.strptime(end_date, '%Y-%m-%d').date(),
-                GA4DataCache.expires_at > datetime.utcnow()
-            ).all()
+            cached = self._load_payloads(website_id, metric_names, start_date, end_date)
+            missing = [metric_name for metric_name in metric_names if metric_name not in cached]
+            if not missing:
+                return cached
             
-            if not cached_entries:
-                return None
-            
-            # Reconstruct the data format
-            data = {
-                'dimension_headers': [],
-                'metric_headers': [{'name': metric_name, 'type': 'TYPE_FLOAT'}],
-                'rows': []
+            keys = {
+                _response_cache_key(website_id, metric_name, start_date, end_date): metric_name
+                for metric_name in missing
             }
+            now = datetime.utcnow()
+            rows = db.session.execute(
+                db.select(GA4ResponseCache.key, GA4ResponseCache.response_json, GA4ResponseCache.expires_at)
+                .where(GA4ResponseCache.key.in_(keys), GA4ResponseCache.expires_at > now)
+            ).all()
             
-            # Group by dimension value
-            dimension_groups = {}
-            has_dimensions = False
-            
-            for entry in cached_entries:
-                if entry.dimension_name and entry.dimension_value:
-                    has_dimensions = True
-                    if entry.dimension_value not in dimension_groups:
-                        dimension_groups[entry.dimension_value] = []
-                    dimension_groups[entry.dimension_value].append(entry)
-                else:
-                    # No dimensions, single row
-                    data['rows'].append({
-                        'metric_values': [{'value': str(entry.metric_value)}]
-                    })
-            
-            if has_dimensions:
-                # Add dimension header
-                first_entry = cached_entries[0]
-                data['dimension_headers'].append({'name': first_entry.dimension_name})
+            for row in rows:
+                metric_name = keys[row.key]
+                data = orjson.loads(row.response_json)
+                cached[metric_name] = data
+                logger.debug("Retrieved cached GA4 data for website %s, metric %s", website_id, metric_name)
                 
-                # Add rows for each dimension value
-                for dim_value, entries in dimension_groups.items():
-                    row = {
-                        'dimension_values': [{'value': dim_value}],
-                        'metric_values': [{'value': str(entries[0].metric_value)}]
-                    }
-                    data['rows'].append(row)
+                # Backfill the shared cache until the row expires
+                ttl = int((row.expires_at - now).total_seconds())
+                if ttl > 0:
+                    self._store_payloads(website_id, {metric_name: data}, start_date, end_date, ttl)
             
-            print(f"Retrieved cached GA4 data for website {website_id}, metric {metric_name}")
-            return data
+            return cached
             
-        except Exception as e:
-            print(f"Failed to retrieve cached data: {str(e)}")
-            return None
+        except Exception:
+            logger.exception("Failed to retrieve cached data")
+            return {}
+    
+    def invalidate_cached_payloads(self, website_id: int):
+        """Drop a website's payloads from the shared cache."""
+        # Bumping the generation orphans every key built with the old one;
+        # inc is atomic on the backend (INCR on Redis)
+        try:
+            cache.cache.inc(ga4_generation_key(website_id))
+        except Exception:
+            logger.exception("Failed to invalidate cached GA4 payloads")
+    
+    def _shared_cache_enabled(self) -> bool:
+        # A per-process SimpleCache can't see clear-cache from other workers,
+        # so payloads are only kept when the cache is Redis
+        return current_app.config.get('CACHE_TYPE') == 'RedisCache'
+    
+    def _payload_keys(self, website_id: int, metric_names: List[str], start_date: str, end_date: str) -> List[str]:
+        generation = cache.get(ga4_generation_key(website_id)) or 0
+        return [
+            ga4_payload_key(website_id, generation, metric_name, start_date, end_date)
+            for metric_name in metric_names
+        ]
+    
+    def _load_payloads(self, website_id: int, metric_names: List[str],
+                       start_date: str, end_date: str) -> Dict[str, Dict[str, Any]]:
+        """Read payloads from the shared cache with a single multi-get."""
+        if not self._shared_cache_enabled():
+            return {}
+        try:
+            keys = self._payload_keys(website_id, metric_names, start_date, end_date)
+            values = cache.get_many(*keys)
+        except Exception:
+            logger.exception("Failed to read cached GA4 payloads")
+            return {}
+        
+        return {
+            metric_name: orjson.loads(value)
+            for metric_name, value in zip(metric_names, values)
+            if value is not None
+        }
+    
+    def _store_payloads(self, website_id: int, payloads: Dict[str, Dict[str, Any]],
+                        start_date: str, end_date: str, timeout: int):
+        """Write payloads to the shared cache as orjson bytes."""
+        if not self._shared_cache_enabled():
+            return
+        try:
+            keys = self._payload_keys(website_id, list(payloads), start_date, end_date)
+            cache.set_many(
+                {key: orjson.dumps(data) for key, data in zip(keys, payloads.values())},
+                timeout=timeout
+            )
+        except Exception:
+            logger.exception("Failed to write cached GA4 payloads")
 
 # Global instance
 ga4_service = GA4Service()
@@ -5,8 +5,13 @@ Handles Google Analytics 4 data fetching with fallback for deployment environmen
 
 import os
 import json
+import logging
 from datetime import datetime, timedelta
 
+logger = logging.getLogger(__name__)
+
+DATE_RANGE_DAYS = {'7d': 7, '30d': 30, '90d': 90}
+
 class GA4Service:
     def __init__(self):
         self.client = None
@@ -17,8 +22,7 @@ class GA4Service:
             # Try to initialize GA4 client if credentials are available
             self._initialize_client()
         except Exception as e:
-            print(f"GA4 client initialization failed: {e}")
-            print("Using mock data for production deployment")
+            logger.warning("GA4 client initialization failed, using mock data: %s", e)
     
     def _initialize_client(self):
         """Initialize GA4 client with credentials"""
@@ -31,21 +35,21 @@ class GA4Service:
                 credentials = service_account.Credentials.from_service_account_file(credentials_path)
                 self.client = BetaAnalyticsDataClient(credentials=credentials)
                 self.initialized = True
-                print("GA4 client initialized successfully")
+                logger.info("GA4 client initialized successfully")
             else:
-                print("GA4 credentials not found, using mock data")
+                logger.warning("GA4 credentials not found, using mock data")
         except ImportError:
-            print("Google Analytics library not available, using mock data")
-        except Exception as e:
-            print(f"GA4 initialization error: {e}")
+            logger.warning("Google Analytics library not available, using mock data")
+        except Exception:
+            logger.exception("GA4 initialization error")
     
     def get_overview_metrics(self, property_id=None, date_range='30d'):
         """Get overview metrics for the dashboard"""
         if self.initialized and self.client:
             try:
                 return self._fetch_real_metrics(property_id, date_range)
-            except Exception as e:
-                print(f"Error fetching real metrics: {e}")
+            except Exception:
+                logger.exception("Error fetching real metrics")
                 return self._get_mock_metrics()
         else:
             return self._get_mock_metrics()
@@ -55,8 +59,8 @@ class GA4Service:
         if self.initialized and self.client:
             try:
                 return self._fetch_realtime_users(property_id)
-            except Exception as e:
-                print(f"Error fetching realtime users: {e}")
+            except Exception:
+                logger.exception("Error fetching realtime users")
                 return {"activeUsers": 21}
         else:
             return {"activeUsers": 21}
@@ -70,16 +74,9 @@ class GA4Service:
             DateRange
         )
         
-        # Calculate date range
+        # Calculate date range; unknown ranges fall back to 30 days
         end_date = datetime.now()
-        if date_range == '7d':
-            start_date = end_date - timedelta(days=7)
-        elif date_range == '30d':
-            start_date = end_date - timedelta(days=30)
-        elif date_range == '90d':
-            start_date = end_date - timedelta(days=90)
-        else:
-            start_date = end_date - timedelta(days=30)
+        start_date = end_date - timedelta(days=DATE_RANGE_DAYS.get(date_range, 30))
         
         request = RunReportRequest(
             property=f"properties/{property_id or self.property_id}",
@@ -0,0 +1,41 @@
+from functools import lru_cache
+import threading
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+
+# One httplib2.Http per thread; each keeps its TLS connections to Google open
+_local = threading.local()
+
+
+@lru_cache(maxsize=None)
+def google_service(name, version):
+    """Discovery-based client for a Google API, built once per process.
+
+    The client carries no credentials; run its requests with
+    ``execute(request, credentials)``.
+    """
+    # An explicit http keeps build from looking up default credentials
+    return build(name, version, http=build_http(), static_discovery=True)
+
+
+def authorized_http(credentials):
+    """Authorized connection for a request made from the current thread.
+
+    httplib2 connections aren't thread-safe, so every thread has its own,
+    reused across requests to save the TCP and TLS handshakes.
+    """
+    http = getattr(_local, 'http', None)
+    if http is None:
+        # build_http sets googleapiclient's default socket timeout
+        http = _local.http = build_http()
+    return AuthorizedHttp(credentials, http=http)
+
+
+def execute(request, credentials):
+    """Run a prepared API request with the given credentials.
+
+    Safe to submit to a thread pool: the connection is picked on the
+    thread that runs the request.
+    """
+    return request.execute(http=authorized_http(credentials))
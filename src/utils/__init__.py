@@ -0,0 +1 @@
+# Shared helpers for routes and services
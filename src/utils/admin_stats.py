@@ -0,0 +1,85 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from src.models.user import db, User
+
+logger = logging.getLogger(__name__)
+
+# Monthly price per paid plan (simplified revenue calculation)
+PLAN_PRICES = {
+    'starter': 49,
+    'professional': 99,
+    'agency': 199
+}
+
+# Postgres materialized view holding the user totals for the admin dashboard
+ADMIN_STATS_VIEW = 'admin_stats_mv'
+ADMIN_STATS_REFRESH_INTERVAL = timedelta(minutes=5)
+
+
+def user_totals_query(recent_cutoff):
+    """SELECT of the admin dashboard user totals in one scan of users."""
+    def count_where(*criteria):
+        return db.func.coalesce(db.func.sum(db.case((db.and_(*criteria), 1), else_=0)), 0)
+
+    return db.select(
+        db.func.count(User.id).label('total_users'),
+        count_where(User.is_active == True).label('active_users'),
+        count_where(User.subscription_status == 'trial').label('trial_users'),
+        count_where(User.custom_billing == True).label('custom_billing_users'),
+        count_where(User.created_at >= recent_cutoff).label('recent_signups'),
+        *[
+            count_where(
+                User.subscription_plan == plan,
+                User.is_active == True,
+                User.custom_billing == False
+            ).label(plan)
+            for plan in PLAN_PRICES
+        ]
+    )
+
+
+def create_admin_stats_view():
+    """Create the admin stats materialized view on Postgres if it doesn't exist."""
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    # created_at holds naive UTC, so the 30 day window is evaluated in UTC
+    # each time the view is refreshed
+    query = user_totals_query(text("(now() at time zone 'utc') - interval '30 days'")).add_columns(
+        db.literal_column('1').label('id'),
+        db.func.now().label('refreshed_at')
+    )
+    definition = query.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+
+    with db.engine.begin() as conn:
+        conn.execute(text(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {ADMIN_STATS_VIEW} AS {definition}'))
+        # REFRESH ... CONCURRENTLY requires a unique index on the view
+        conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS ix_{ADMIN_STATS_VIEW}_id ON {ADMIN_STATS_VIEW} (id)'))
+
+
+def admin_user_totals():
+    """Return the user totals row, from the materialized view where available."""
+    if db.engine.dialect.name == 'postgresql':
+        try:
+            return _read_admin_stats_view()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Falling back to live admin stats")
+
+    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+    return db.session.execute(user_totals_query(thirty_days_ago)).one()
+
+
+def _read_admin_stats_view():
+    """Read the view's single row, refreshing it first once it is stale."""
+    select_view = text(f'SELECT * FROM {ADMIN_STATS_VIEW}')
+    totals = db.session.execute(select_view).one()
+
+    if totals.refreshed_at < datetime.now(timezone.utc) - ADMIN_STATS_REFRESH_INTERVAL:
+        # CONCURRENTLY keeps the view readable while it is rebuilt
+        with db.engine.begin() as conn:
+            conn.execute(text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {ADMIN_STATS_VIEW}'))
+        totals = db.session.execute(select_view).one()
+
+    return totals
@@ -0,0 +1,125 @@
+import time
+from collections import namedtuple
+from functools import wraps
+from flask import current_app, jsonify
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy.orm import joinedload
+from src.models.user import db, User, Client
+from src.utils import jwt_cache
+from src.utils.cache import cache, revoked_token_key, user_key
+
+
+# Who a request is from and what they may reach, as carried by their token
+Principal = namedtuple('Principal', ['user_id', 'role', 'client_id'])
+
+
+def token_claims(user):
+    """Extra JWT claims issued with every access and refresh token for a user."""
+    return {
+        'role': user.role,
+        'client_id': user.client.id if user.client else None,
+        'ver': user.token_version
+    }
+
+
+def current_principal():
+    """Return the authenticated user's Principal, or None if the user doesn't exist.
+
+    Role and client come from the token's claims, so this is normally no
+    query. Tokens issued before the client_id claim existed, and client
+    tokens issued before the user had a client profile, fall back to the
+    user cache.
+    """
+    claims = get_jwt()
+    user_id = int(get_jwt_identity())
+    role, client_id = claims.get('role'), claims.get('client_id')
+
+    if role is None or (role == 'client' and client_id is None):
+        cached = get_user_cached(user_id)
+        if cached is None:
+            return None
+        role = cached['user']['role']
+        client_id = cached['client']['id'] if cached['client'] else None
+
+    return Principal(user_id, role, client_id)
+
+
+def with_principal(f):
+    """Decorator passing the authenticated user's Principal to the view as principal=, or answering 404.
+
+    Goes under jwt_required().
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        principal = current_principal()
+        if principal is None:
+            return jsonify({'message': 'User not found'}), 404
+        return f(*args, principal=principal, **kwargs)
+    return decorated_function
+
+
+def get_user_cached(user_id):
+    """Return the cached profile of a user as plain dicts, or None if the user doesn't exist.
+
+    The value holds 'user' and 'client' (to_dict output, client None when
+    there is no profile) and the 'claims' for new access tokens. Callers
+    that modify the user load the ORM instance instead and then call
+    invalidate_user.
+    """
+    key = user_key(user_id)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    user = db.session.get(
+        User, user_id, options=[joinedload(User.client).lazyload(Client.websites)]
+    )
+    if not user:
+        return None
+
+    cached = {
+        'user': user.to_dict(),
+        'client': user.client.to_dict() if user.client else None,
+        'claims': token_claims(user)
+    }
+    cache.set(key, cached, timeout=_user_cache_timeout())
+    return cached
+
+
+def invalidate_user(user_id):
+    """Forget cached state for a user after their account or profile changes."""
+    cache.delete(user_key(user_id))
+    jwt_cache.invalidate(user_id)
+
+
+def revoke_token(claims):
+    """Revoke a decoded JWT for the rest of its lifetime."""
+    # The marker expires with the token, so revoked tokens never pile up
+    ttl = int(claims['exp'] - time.time())
+    if ttl > 0:
+        cache.set(revoked_token_key(claims['jti']), 1, timeout=ttl)
+
+
+def token_revoked(jwt_header, jwt_payload):
+    """token_in_blocklist_loader callback: True once a token has been revoked.
+
+    A token is revoked by logging out with it, by bumping the user's
+    token_version, which revokes every older token at once, or by
+    deleting the user.
+    """
+    if cache.has(revoked_token_key(jwt_payload['jti'])):
+        return True
+
+    # The version comes from the user cache, so this is normally no query.
+    # Views trust the token's claims, so a deleted user's tokens are revoked too.
+    cached = get_user_cached(int(jwt_payload['sub']))
+    return cached is None or jwt_payload.get('ver', 0) != cached['claims']['ver']
+
+
+def _user_cache_timeout():
+    # Redis is shared by all workers and sees every invalidation, so entries
+    # can live as long as an access token. A per-process cache only sees its
+    # own worker's invalidations, so it keeps the default short timeout.
+    if current_app.config.get('CACHE_TYPE') == 'RedisCache':
+        return int(current_app.config['JWT_ACCESS_TOKEN_EXPIRES'].total_seconds())
+    return None
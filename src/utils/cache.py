@@ -0,0 +1,61 @@
+from flask_caching import Cache
+
+# Configured in create_app: Redis when REDIS_URL is set, otherwise in-process
+cache = Cache()
+
+ADMIN_STATS_KEY = 'admin:stats'
+
+
+def user_key(user_id):
+    """Key for a user's cached profile (see src.utils.auth.get_user_cached)."""
+    return f'user:{user_id}'
+
+
+def revoked_token_key(jti):
+    """Marker for a revoked JWT, kept until the token would have expired."""
+    return f'auth:revoked:{jti}'
+
+
+def oauth_state_key(state):
+    """Pending Google OAuth flow, by its state parameter."""
+    return f'ga4:oauth:state:{state}'
+
+
+def oauth_tokens_key(user_id):
+    """Google tokens from a finished OAuth callback, waiting for the user to complete the connection."""
+    return f'ga4:oauth:tokens:{user_id}'
+
+
+def ga4_token_key(account_id):
+    """A GA4 account's current Google access token and its expiry."""
+    return f'ga4:token:{account_id}'
+
+
+def ga4_report_key(property_id, report, start_date, end_date):
+    """A formatted GA4 report for a property (see src.services.ga4_data)."""
+    return f'ga4:report:{property_id}:{report}:{start_date}:{end_date}'
+
+
+def ga4_generation_key(website_id):
+    """Counter bumped to invalidate all of a website's cached GA4 payloads."""
+    return f'ga4:{website_id}:gen'
+
+
+def ga4_payload_key(website_id, generation, metric_name, start_date, end_date):
+    """Key for one cached GA4 payload."""
+    return f'ga4:{website_id}:{generation}:{metric_name}:{start_date}:{end_date}'
+
+
+def cache_take(key):
+    """Get and delete a key; None if it is missing or another request took it first."""
+    value = cache.get(key)
+    # Only the request whose delete removed the key gets to use the value
+    if value is None or not cache.delete(key):
+        return None
+    return value
+
+
+def cache_ok(rv):
+    """Response filter so only successful responses are cached."""
+    status = rv[1] if isinstance(rv, tuple) else getattr(rv, 'status_code', 200)
+    return status == 200
@@ -0,0 +1,32 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+class WorkerPool:
+    """A ThreadPoolExecutor created on first use in each process.
+
+    Module-level pools are created at import, which with preload_app happens
+    in the gunicorn master. An executor that already started threads there
+    would hand its work to threads that don't exist in the forked worker, so
+    each worker starts with no executor and builds its own.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._executor = None
+        self._lock = Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix
+                    )
+        return self._executor.submit(fn, *args, **kwargs)
@@ -0,0 +1,30 @@
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    # Naive datetimes keep their isoformat() shape, matching earlier responses
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj).decode()
+
+    def dumpb(self, obj):
+        """Serialize to UTF-8 bytes, skipping the str round trip."""
+        return orjson.dumps(obj, option=self.option, default=self.default)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """jsonify() straight from orjson's bytes, without a str in between."""
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self.option
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+
+        # Same trailing newline as Flask's default provider
+        body = orjson.dumps(obj, option=option, default=self.default) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
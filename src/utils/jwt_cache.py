@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# invalidate() only reaches the worker it runs in, so an entry is trusted for
+# at most MAX_AGE seconds (and never past its token's expiry); a role change or
+# deactivation made through another worker takes effect within that window.
+# The size cap bounds memory for long-running workers.
+MAX_AGE = 60
+MAX_ENTRIES = 4096
+
+_entries = OrderedDict()
+_lock = Lock()
+
+
+def get(jti, user_id):
+    """Return the cached (role, is_active) for a token, or None on a miss or expiry."""
+    key = (jti, user_id)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        role, is_active, expires_at = entry
+        if expires_at <= time.time():
+            del _entries[key]
+            return None
+        _entries.move_to_end(key)
+        return role, is_active
+
+
+def put(jti, user_id, role, is_active, expires_at):
+    """Cache the user state looked up for a token for up to MAX_AGE seconds."""
+    expires_at = min(expires_at, time.time() + MAX_AGE)
+    with _lock:
+        _entries[(jti, user_id)] = (role, is_active, expires_at)
+        _entries.move_to_end((jti, user_id))
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def invalidate(user_id):
+    """Drop every cached token entry for a user."""
+    with _lock:
+        for key in [k for k in _entries if k[1] == user_id]:
+            del _entries[key]
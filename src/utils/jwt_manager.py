@@ -0,0 +1,35 @@
+import time
+from hashlib import blake2b
+from threading import Lock
+
+from cachetools import TTLCache
+from flask_jwt_extended import JWTManager
+
+
+class CachingJWTManager(JWTManager):
+    """JWTManager that remembers the claims of tokens it has already verified.
+
+    Only signature/claims decoding is cached. Token type, blocklist and
+    custom verification checks still run on every request.
+    """
+
+    def __init__(self, app=None, maxsize=4096, ttl=3600, **kwargs):
+        self._verified = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._verified_lock = Lock()
+        super().__init__(app, **kwargs)
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        # CSRF and expired-token decodes need the full path every time
+        if csrf_value is not None or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+        key = blake2b(encoded_token.encode(), digest_size=16).digest()
+        with self._verified_lock:
+            claims = self._verified.get(key)
+        if claims is not None and claims.get('exp', float('inf')) > time.time():
+            return dict(claims)
+
+        claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+        with self._verified_lock:
+            self._verified[key] = claims
+        return dict(claims)
@@ -0,0 +1,12 @@
+from flask import current_app
+from sqlalchemy.orm import raiseload
+
+
+def strict_loading(query):
+    """Make undeclared lazy loads raise when SQLALCHEMY_RAISELOAD is enabled.
+
+    Works on both legacy Query objects and 2.0-style select() statements.
+    """
+    if current_app.config.get('SQLALCHEMY_RAISELOAD'):
+        return query.options(raiseload('*'))
+    return query
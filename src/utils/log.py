@@ -0,0 +1,76 @@
+import atexit
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+
+_queue = queue.SimpleQueue()
+_listener = None
+
+
+class TracebackSampler(logging.Filter):
+    """Keep the traceback of the first error from each call site per interval.
+
+    Later records from the same site within the interval are logged without
+    exc_info, so an error storm doesn't spend its time formatting the same
+    traceback over and over.
+    """
+
+    def __init__(self, interval=60):
+        super().__init__()
+        self.interval = interval
+        self._last_seen = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.exc_info:
+            site = (record.pathname, record.lineno)
+            now = time.monotonic()
+            with self._lock:
+                sampled = now - self._last_seen.get(site, float('-inf')) >= self.interval
+                if sampled:
+                    self._last_seen[site] = now
+            if not sampled:
+                record.exc_info = None
+                record.exc_text = None
+        return True
+
+
+def configure_logging():
+    """Route log records through a queue to a background writer thread.
+
+    Request threads only enqueue records; formatting and the write to
+    stderr happen on the listener thread. Does nothing if the root logger
+    is already configured.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+
+    handler = QueueHandler(_queue)
+    handler.addFilter(TracebackSampler())
+    root.addHandler(handler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    _start_listener()
+    # Threads don't survive fork, so each gunicorn worker starts its own
+    os.register_at_fork(after_in_child=_start_listener)
+    atexit.register(_stop_listener)
+
+
+def _start_listener():
+    global _listener
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = QueueListener(_queue, output)
+    _listener.start()
+
+
+def _stop_listener():
+    # Flushes records still in the queue
+    if _listener is not None:
+        _listener.stop()
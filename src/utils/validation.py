@@ -0,0 +1,26 @@
+from flask import request, jsonify
+
+CLIENT_CREATE_FIELDS = ('email', 'password', 'full_name', 'company_name')
+
+
+def normalize_email(email):
+    """Canonical stored form of an email address: trimmed and lowercased."""
+    # strip() returns the same string when there is nothing to trim, so the
+    # common case allocates only the lowercased copy
+    return email.strip().lower()
+
+
+def json_payload(required=()):
+    """Parse the JSON body once and check required fields.
+
+    Returns (data, None) on success or (None, error_response) on failure.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None, (jsonify({'message': 'Request body must be a JSON object'}), 400)
+
+    for field in required:
+        if not data.get(field):
+            return None, (jsonify({'message': f'{field} is required'}), 400)
+
+    return data, None